@@ -0,0 +1,67 @@
+"""
+Measures LRULocalBackend throughput under thread contention.
+
+Each thread runs a random get-or-set workload against one shared backend.
+Results are reported in operations per second for every combination of
+thread count and lock stripe count.
+
+    python benchmarks/lru_contention.py
+    python benchmarks/lru_contention.py --threads 1 8 64 --stripes 1 4 16 --ops 50000
+"""
+import argparse
+import random
+import threading
+import time
+
+from dogpile.cache.api import NO_VALUE
+
+from dorthy.cache import LRULocalBackend
+
+
+def _worker(backend, keys, ops, seed, barrier):
+    rnd = random.Random(seed)
+    barrier.wait()
+    for _ in range(ops):
+        key = keys[rnd.randrange(len(keys))]
+        if backend.get(key) is NO_VALUE:
+            backend.set(key, key)
+
+
+def run(threads, stripes, ops, key_count, maxsize):
+    """
+    Runs the workload once
+
+    :return: the operations per second over all threads
+    """
+    backend = LRULocalBackend(dict(maxsize=maxsize, stripes=stripes))
+    keys = ["key:{}".format(i) for i in range(key_count)]
+    # the main thread releases the workers together
+    barrier = threading.Barrier(threads + 1)
+    workers = [threading.Thread(target=_worker, args=(backend, keys, ops, seed, barrier))
+               for seed in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return threads * ops / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--stripes", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--ops", type=int, default=20000, help="operations per thread")
+    parser.add_argument("--keys", type=int, default=2048, help="number of distinct keys")
+    parser.add_argument("--maxsize", type=int, default=1024, help="maximum number of cache entries")
+    args = parser.parse_args()
+
+    print("{:>8}".format("threads") + "".join("{:>14}".format("{} stripes".format(s)) for s in args.stripes))
+    for threads in args.threads:
+        results = [run(threads, stripes, args.ops, args.keys, args.maxsize) for stripes in args.stripes]
+        print("{:>8}".format(threads) + "".join("{:>14.0f}".format(r) for r in results))
+
+
+if __name__ == "__main__":
+    main()
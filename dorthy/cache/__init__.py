@@ -0,0 +1,215 @@
+import hashlib
+import logging
+import sys
+import threading
+import types
+
+from cachetools import LRUCache, TTLCache
+
+from dogpile.cache import register_backend
+from dogpile.cache.api import CacheBackend, NO_VALUE
+
+from dorthy.security import crypto
+
+
+logger = logging.getLogger(__name__)
+
+
+def sha2_mangle_key(key):
+    return crypto.secure_hash(key, crypto.SecureHashAlgorithms.SHA2)
+
+
+def short_mangle_key(key, max_length=128):
+    """
+    A cheaper key mangler that only hashes (SHA1) keys longer than the max length
+    """
+    if len(key) <= max_length:
+        return key
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+# shared framework objects that are not part of a cached value's footprint
+_SHARED_TYPES = (types.ModuleType, type, types.FunctionType, types.BuiltinFunctionType,
+                 types.MethodType, logging.Logger)
+
+# attributes referencing shared state - e.g. the SQLAlchemy mapper graph
+_SHARED_ATTRIBUTES = frozenset(["_sa_instance_state"])
+
+
+def estimate_size(value):
+    """
+    Estimates the memory footprint of a value in bytes by walking
+    containers and instance attributes.  Shared objects are counted once
+    and modules, classes, functions, loggers and SQLAlchemy instance state
+    are not counted.
+    """
+    seen = set()
+    size = 0
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, (str, bytes, bytearray, int, float)):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, "__dict__"):
+            attributes = obj.__dict__
+            seen.add(id(attributes))
+            size += sys.getsizeof(attributes)
+            stack.extend(v for k, v in attributes.items() if k not in _SHARED_ATTRIBUTES)
+    return size
+
+
+class _EvictionCountingMixin(object):
+
+    evictions = 0
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+
+class _LRUCache(_EvictionCountingMixin, LRUCache):
+    pass
+
+
+class _TTLCache(_EvictionCountingMixin, TTLCache):
+    pass
+
+
+class LRULocalBackend(CacheBackend):
+    """
+    An in-process LRU (or TTL) cache backend.  The underlying cachetools
+    caches are not thread safe so every operation holds a lock.  Under heavy
+    contention the cache can be split into lock stripes, each holding an
+    equal share of maxsize with LRU order maintained per stripe.
+
+    If max_bytes is set the cache is bounded by the estimated memory footprint
+    of its values instead of the number of entries.  Least recently used
+    entries are evicted until the new value fits and values larger than the
+    budget (of a stripe) are not cached.
+
+    Arguments:
+        maxsize: the maximum number of entries
+        max_bytes: the maximum estimated size in bytes - overrides maxsize
+        sizer: function returning the size of a value in bytes (default estimate_size)
+        ttl: the time to live in seconds or None
+        stripes: the number of lock stripes (default 1)
+        lock_factory: optional mutex factory - e.g. dorthy.redis.lock_factory
+    """
+
+    def __init__(self, arguments):
+        max_bytes = arguments.get("max_bytes", None)
+        maxsize = max_bytes if max_bytes else arguments.get("maxsize", 1024)
+        sizer = arguments.get("sizer", estimate_size) if max_bytes else None
+        ttl = arguments.get("ttl", None)
+        stripes = max(1, arguments.get("stripes", 1))
+        # optional mutex factory - e.g. dorthy.redis.lock_factory for distributed locks
+        self.__lock_factory = arguments.get("lock_factory", None)
+        self.__rejected = 0
+        stripe_size = max(1, maxsize // stripes)
+        self.__stripes = [(threading.Lock(),
+                           _TTLCache(stripe_size, ttl=ttl, getsizeof=sizer) if ttl else
+                           _LRUCache(stripe_size, getsizeof=sizer))
+                          for _ in range(stripes)]
+
+    def _stripe(self, key):
+        return self.__stripes[hash(key) % len(self.__stripes)]
+
+    def _group(self, keys):
+        # groups keys by stripe so that each lock is acquired once per multi operation
+        if len(self.__stripes) == 1:
+            return [(self.__stripes[0], list(enumerate(keys)))]
+        groups = dict()
+        for indx, key in enumerate(keys):
+            groups.setdefault(hash(key) % len(self.__stripes), []).append((indx, key))
+        return [(self.__stripes[stripe], items) for stripe, items in groups.items()]
+
+    def get_mutex(self, key):
+        return self.__lock_factory(key) if self.__lock_factory else None
+
+    def get(self, key):
+        lock, cache = self._stripe(key)
+        with lock:
+            return cache.get(key, NO_VALUE)
+
+    def get_multi(self, keys):
+        values = [NO_VALUE] * len(keys)
+        for (lock, cache), items in self._group(keys):
+            with lock:
+                for indx, key in items:
+                    values[indx] = cache.get(key, NO_VALUE)
+        return values
+
+    def _set(self, cache, key, value):
+        try:
+            cache[key] = value
+        except ValueError:
+            # value is larger than the cache budget - drop any stale value
+            cache.pop(key, None)
+            self.__rejected += 1
+            logger.debug("Value too large for local cache: %s", key)
+
+    def set(self, key, value):
+        lock, cache = self._stripe(key)
+        with lock:
+            self._set(cache, key, value)
+
+    def set_multi(self, mapping):
+        keys = list(mapping.keys())
+        for (lock, cache), items in self._group(keys):
+            with lock:
+                for _, key in items:
+                    self._set(cache, key, mapping[key])
+
+    def delete(self, key):
+        lock, cache = self._stripe(key)
+        with lock:
+            cache.pop(key, None)
+
+    def delete_multi(self, keys):
+        for (lock, cache), items in self._group(keys):
+            with lock:
+                for _, key in items:
+                    cache.pop(key, None)
+
+    def items(self):
+        """
+        Returns a point in time copy of the cached entries
+
+        :return: a list of (key, value) tuples
+        """
+        items = list()
+        for lock, cache in self.__stripes:
+            with lock:
+                items.extend(cache.items())
+        return items
+
+    def stats(self):
+        """
+        Returns the current size of the cache.  Bytes are the estimated
+        size of the values when max_bytes is set, otherwise the entry count.
+
+        :return: a dict with bytes, entries, evictions and rejected counts
+        """
+        current = entries = evictions = 0
+        for lock, cache in self.__stripes:
+            with lock:
+                current += cache.currsize
+                entries += len(cache)
+                evictions += cache.evictions
+        return dict(bytes=current, entries=entries, evictions=evictions, rejected=self.__rejected)
+
+
+register_backend("dorthy.cache.local.lru", "dorthy.cache", "LRULocalBackend")
+register_backend("dorthy.cache.redis", "dorthy.cache.redis", "RedisBackend")
+register_backend("dorthy.cache.layered", "dorthy.cache.layered", "LayeredBackend")
+register_backend("dorthy.cache.shared", "dorthy.cache.shared", "SharedMemoryBackend")
@@ -0,0 +1,190 @@
+import logging
+
+from sqlalchemy import event, orm
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm.exc import NoResultFound, StaleDataError
+
+from dorthy import db
+
+
+logger = logging.getLogger(__name__)
+
+ENTITY_KEY_PREFIX = "entity"
+
+_READ_ONLY_ATTR = "_entity_cache_read_only"
+_PENDING_KEYS = "entity_cache_keys"
+
+_caches = list()
+
+
+class EntityCache(object):
+    """
+    Caches entities loaded by id in a dogpile region.  Entities are loaded
+    in a private session and returned detached and marked read-only: they
+    cannot be attached to or flushed by a session.  Use Session().merge
+    to obtain a writable copy.
+
+    Cached entries are invalidated after the commit of a transaction that
+    updated or deleted the row - never before the commit.  VersionedMixin
+    entities are also cached by version so that find_by_id_versioned keeps
+    its StaleDataError semantics.
+    """
+
+    def __init__(self, region, entity_types=None):
+        """
+        :param region: the configured dogpile region
+        :param entity_types: the entity types to cache or None for all
+        """
+        self.region = region
+        self.entity_types = frozenset(entity_types) if entity_types else None
+        _caches.append(self)
+        # bulk statements only collect the written rows if someone listens
+        db.Session.register_written_listener(_collect_bulk_writes)
+
+    def cacheable(self, entity_type):
+        return self.entity_types is None or entity_type in self.entity_types
+
+    @staticmethod
+    def key(entity_type, entity_id, version_id=None):
+        key = "{}:{}:{}".format(ENTITY_KEY_PREFIX, entity_type.__tablename__, entity_id)
+        return key if version_id is None else "{}:v{}".format(key, version_id)
+
+    @staticmethod
+    def _load(entity_type, entity_id, version_id=None):
+        # use a private session so that the caller's session is not affected
+        session = orm.Session(bind=db.Session().get_bind())
+        try:
+            query = session.query(entity_type).filter(entity_type.id == entity_id)
+            if version_id is not None:
+                query = query.filter(entity_type.version_id == version_id)
+            entity = query.one()
+        except NoResultFound:
+            entity = None
+        finally:
+            # closing the session detaches the entity
+            session.close()
+        if entity is not None:
+            setattr(entity, _READ_ONLY_ATTR, True)
+        return entity
+
+    def find_by_id(self, entity_type, entity_id, not_found_error=True):
+        if not self.cacheable(entity_type):
+            return db.find_by_id(entity_type, entity_id, not_found_error=not_found_error)
+        entity = self.region.get_or_create(self.key(entity_type, entity_id),
+                                           lambda: self._load(entity_type, entity_id),
+                                           should_cache_fn=lambda value: value is not None)
+        if entity is None and not_found_error:
+            raise NoResultFound("No row was found for one()")
+        return entity
+
+    def find_by_id_versioned(self, entity_type, entity_id, version_id):
+        if not self.cacheable(entity_type):
+            return db.find_by_id_versioned(entity_type, entity_id, version_id)
+        entity = self.region.get_or_create(self.key(entity_type, entity_id, version_id),
+                                           lambda: self._load(entity_type, entity_id, version_id),
+                                           should_cache_fn=lambda value: value is not None)
+        if entity is None:
+            raise StaleDataError("Entity not found for version - id: {}, version: {}".format(entity_id, version_id))
+        return entity
+
+    def invalidate(self, entity_type, entity_id, version_id=None):
+        """
+        Removes the cached entity - prefer the automatic commit invalidation
+        """
+        keys = [self.key(entity_type, entity_id)]
+        if version_id is not None:
+            keys.append(self.key(entity_type, entity_id, version_id))
+        self.region.delete_multi(keys)
+
+    def _invalidation_keys(self, entity):
+        entity_type = type(entity)
+        if not self.cacheable(entity_type) or getattr(entity, "id", None) is None:
+            return []
+        keys = [self.key(entity_type, entity.id)]
+        if isinstance(entity, db.VersionedMixin) and entity.version_id is not None:
+            # the version before the flush is the one that becomes stale
+            keys.append(self.key(entity_type, entity.id, entity.version_id))
+        return keys
+
+
+def _invalidate_pending(session):
+    pending = session.info.pop(_PENDING_KEYS, None)
+    if pending:
+        for cache, keys in pending.items():
+            try:
+                cache.region.delete_multi(list(keys))
+            except Exception:
+                logger.exception("Failed to invalidate entity cache keys.")
+
+
+def _pending_keys(session):
+    pending = session.info.get(_PENDING_KEYS)
+    if pending is None:
+        pending = session.info[_PENDING_KEYS] = dict()
+        if hasattr(session, "register_after_commit"):
+            session.register_after_commit(lambda: _invalidate_pending(session), handle_error=True)
+    return pending
+
+
+def _collect_writes(session, entity_type, written):
+    pending = _pending_keys(session)
+    for cache in _caches:
+        if cache.cacheable(entity_type):
+            keys = pending.setdefault(cache, set())
+            for entity_id, version_id in written:
+                keys.add(cache.key(entity_type, entity_id))
+                if version_id is not None:
+                    keys.add(cache.key(entity_type, entity_id, version_id))
+
+
+def _collect_versioned_write(event_name, write):
+    # entities written by db.update_versioned / db.delete_versioned_fast
+    if event_name != "versioned_write" or not _caches:
+        return
+    session, entity_type, entity_id, version_id = write
+    _collect_writes(session, entity_type, [(entity_id, version_id)])
+
+
+def _collect_bulk_writes(session, entity_type, written):
+    # rows written by db.bulk_upsert / db.bulk_delete
+    if written:
+        _collect_writes(session, entity_type, written)
+
+
+db.Session.register_listener(_collect_versioned_write)
+
+
+@event.listens_for(orm.Session, "before_attach")
+def _prevent_read_only_attach(session, instance):
+    if getattr(instance, _READ_ONLY_ATTR, False):
+        raise InvalidRequestError("Cached entities are read-only - use Session().merge to obtain a writable copy.")
+
+
+@event.listens_for(orm.Session, "before_flush")
+def _collect_invalidations(session, flush_context, instances):
+    if not _caches:
+        return
+    modified = [obj for obj in session.dirty if session.is_modified(obj)]
+    modified.extend(session.deleted)
+    if not modified:
+        return
+
+    pending = _pending_keys(session)
+    for cache in _caches:
+        for obj in modified:
+            keys = cache._invalidation_keys(obj)
+            if keys:
+                pending.setdefault(cache, set()).update(keys)
+
+
+@event.listens_for(orm.Session, "after_commit")
+def _invalidate_after_commit(session):
+    # sessions not created by db.Session have no after commit callbacks
+    if not hasattr(session, "register_after_commit"):
+        _invalidate_pending(session)
+
+
+@event.listens_for(orm.Session, "after_rollback")
+def _discard_after_rollback(session):
+    # nothing was committed - cached entries are still valid
+    session.info.pop(_PENDING_KEYS, None)
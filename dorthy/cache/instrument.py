@@ -0,0 +1,186 @@
+import logging
+import threading
+import time
+
+from dogpile.cache.api import NO_VALUE
+from dogpile.cache.proxy import ProxyBackend
+from tornado.ioloop import PeriodicCallback
+
+from dorthy import metrics
+
+
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = "cache"
+
+# bounds the pending generation timestamps kept per thread
+_MAX_PENDING_GENERATIONS = 1024
+
+_instrumented = dict()
+
+
+class MetricsProxy(ProxyBackend):
+    """
+    A dogpile.cache proxy that records per region metrics in the dorthy.metrics
+    registry: hits, misses, sets, deletes, backend latency and the value
+    generation time (elapsed time between a miss and the set of the key
+    on the same thread).  Size and eviction gauges are read from the
+    backend's stats method when it provides one.
+
+    Misses are counted per backend call - dogpile checks the backend again
+    after acquiring the mutex so a single regeneration records two misses.
+    """
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.__pending = threading.local()
+
+    def wrap(self, backend):
+        proxy = super().wrap(backend)
+        stats = self.backend_stats()
+        if stats is not None:
+            for stat in stats:
+                metrics.register_gauge(self._metric(stat),
+                                       lambda stat=stat: (self.backend_stats() or {}).get(stat))
+        return proxy
+
+    def _metric(self, name):
+        return "{}.{}.{}".format(METRICS_PREFIX, self.name, name)
+
+    def _latency(self, op, start):
+        metrics.observe(self._metric("latency." + op), time.time() - start)
+
+    def _pending(self):
+        if not hasattr(self.__pending, "misses"):
+            self.__pending.misses = dict()
+        return self.__pending.misses
+
+    def _missed(self, key):
+        pending = self._pending()
+        if len(pending) >= _MAX_PENDING_GENERATIONS:
+            pending.clear()
+        pending[key] = time.time()
+
+    def _generated(self, key):
+        start = self._pending().pop(key, None)
+        if start is not None:
+            metrics.observe(self._metric("generation"), time.time() - start)
+
+    def backend_stats(self):
+        """
+        :return: the stats of the concrete backend or None if it does not provide stats
+        """
+        backend = self.proxied
+        while isinstance(backend, ProxyBackend):
+            backend = backend.proxied
+        return backend.stats() if hasattr(backend, "stats") else None
+
+    def get(self, key):
+        start = time.time()
+        value = self.proxied.get(key)
+        self._latency("get", start)
+        if value is NO_VALUE:
+            metrics.incr(self._metric("misses"))
+            self._missed(key)
+        else:
+            metrics.incr(self._metric("hits"))
+        return value
+
+    def get_multi(self, keys):
+        start = time.time()
+        values = self.proxied.get_multi(keys)
+        self._latency("get_multi", start)
+        misses = 0
+        for key, value in zip(keys, values):
+            if value is NO_VALUE:
+                misses += 1
+                self._missed(key)
+        metrics.incr(self._metric("misses"), misses)
+        metrics.incr(self._metric("hits"), len(keys) - misses)
+        return values
+
+    def set(self, key, value):
+        start = time.time()
+        self.proxied.set(key, value)
+        self._latency("set", start)
+        metrics.incr(self._metric("sets"))
+        self._generated(key)
+
+    def set_multi(self, mapping):
+        start = time.time()
+        self.proxied.set_multi(mapping)
+        self._latency("set_multi", start)
+        metrics.incr(self._metric("sets"), len(mapping))
+        for key in mapping:
+            self._generated(key)
+
+    def delete(self, key):
+        start = time.time()
+        self.proxied.delete(key)
+        self._latency("delete", start)
+        metrics.incr(self._metric("deletes"))
+
+    def delete_multi(self, keys):
+        start = time.time()
+        self.proxied.delete_multi(keys)
+        self._latency("delete_multi", start)
+        metrics.incr(self._metric("deletes"), len(keys))
+
+
+def instrument(region, name=None):
+    """
+    Instruments a configured dogpile region with a MetricsProxy
+
+    :param region: the configured region
+    :param name: the region name used for metrics - defaults to the region name
+    :return: the region
+    """
+    name = name if name is not None else region.name
+    if not name:
+        raise ValueError("A name is required to instrument a cache region.")
+    proxy = MetricsProxy(name)
+    region.wrap(proxy)
+    _instrumented[name] = proxy
+    return region
+
+
+def region_stats(name):
+    """
+    Returns the metrics recorded for an instrumented region
+
+    :param name: the region name
+    :return: a dict of the region's metrics including the hit ratio
+    """
+    prefix = "{}.{}.".format(METRICS_PREFIX, name)
+    snapshot = metrics.snapshot(prefix)
+    stats = dict((k[len(prefix):], v) for k, v in snapshot["counters"].items())
+    stats.update((k[len(prefix):], v) for k, v in snapshot["gauges"].items())
+    stats.update((k[len(prefix):], v) for k, v in snapshot["timings"].items())
+    hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+    stats["hit_ratio"] = float(hits) / (hits + misses) if hits + misses else 0.0
+    return stats
+
+
+def all_region_stats():
+    """
+    :return: a dict of region name to region stats for all instrumented regions
+    """
+    return dict((name, region_stats(name)) for name in list(_instrumented))
+
+
+def log_region_stats(interval, log_level=logging.INFO):
+    """
+    Periodically logs the stats of all instrumented regions on the IOLoop
+
+    :param interval: the logging interval in seconds
+    :param log_level: the log level
+    :return: the started PeriodicCallback
+    """
+    def _log():
+        for name, stats in all_region_stats().items():
+            logger.log(log_level, "Cache region stats - %s: %s", name, stats)
+
+    callback = PeriodicCallback(_log, interval * 1000)
+    callback.start()
+    return callback
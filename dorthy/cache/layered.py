@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import threading
+
+from uuid import uuid4
+
+from dogpile.cache.api import CacheBackend, NO_VALUE
+
+from dorthy.cache import LRULocalBackend, short_mangle_key
+from dorthy.cache.redis import RedisBackend
+
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL_PREFIX = "cache:invalidate"
+
+
+class LayeredBackend(CacheBackend):
+    """
+    A two level dogpile.cache backend.  Values are read from an in-process
+    LRULocalBackend (L1) first and then from redis (L2).  L2 hits populate L1.
+    Sets and deletes are published on a redis channel so that every other
+    process drops its stale L1 entry.  An L2 value is not copied into L1 if
+    an invalidation arrived while it was read - it may predate the
+    invalidation.
+
+    Arguments:
+        name: the region name used for the invalidation channel
+        local_maxsize: the maximum number of L1 entries
+        local_ttl: the L1 time to live in seconds (default 60) - bounds staleness if a message is lost
+        invalidation_channel: overrides the invalidation channel name
+        key_mangler: function used to mangle keys - defaults to dorthy.cache.short_mangle_key, None to disable
+        all other arguments are passed to the RedisBackend
+    """
+
+    def __init__(self, arguments):
+        self.__local = LRULocalBackend(dict(maxsize=arguments.get("local_maxsize", 1024),
+                                            ttl=arguments.get("local_ttl", 60)))
+        self.__remote = RedisBackend(arguments)
+        # long generated keys are hashed unless a mangler (or None) is configured
+        self.key_mangler = arguments.get("key_mangler", short_mangle_key)
+
+        self.__client = self.__remote.client
+        self.__channel = arguments.get("invalidation_channel",
+                                       "{}:{}".format(INVALIDATION_CHANNEL_PREFIX, arguments.get("name", "default")))
+        self.__origin = uuid4().hex
+        self.__pid = None
+        self.__subscriber = None
+        self.__lock = threading.Lock()
+        # incremented by every invalidation of L1 entries - the generation and
+        # the counters are updated by request threads and the subscriber thread
+        self.__generation = 0
+        self.__counter_lock = threading.Lock()
+
+        self.__l1_hits = 0
+        self.__l2_hits = 0
+        self.__misses = 0
+
+    def _ensure_subscribed(self):
+        # subscribe lazily and per process - threads do not survive a fork
+        if self.__pid == os.getpid():
+            return
+        with self.__lock:
+            if self.__pid != os.getpid():
+                pubsub = self.__client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{self.__channel: self._on_invalidate})
+                self.__subscriber = pubsub.run_in_thread(sleep_time=1, daemon=True)
+                self.__pid = os.getpid()
+
+    def _on_invalidate(self, message):
+        try:
+            data = json.loads(message["data"].decode("utf-8"))
+        except (ValueError, AttributeError):
+            logger.warn("Invalid cache invalidation message on channel: %s", self.__channel)
+            return
+        if data.get("origin") != self.__origin:
+            self._invalidated()
+            self.__local.delete_multi(data.get("keys", []))
+
+    def _publish(self, keys):
+        try:
+            self.__client.publish(self.__channel, json.dumps(dict(origin=self.__origin, keys=list(keys))))
+        except Exception:
+            logger.exception("Failed to publish cache invalidation on channel: %s", self.__channel)
+
+    def _invalidated(self):
+        with self.__counter_lock:
+            self.__generation += 1
+
+    def _count(self, l1_hits=0, l2_hits=0, misses=0):
+        with self.__counter_lock:
+            self.__l1_hits += l1_hits
+            self.__l2_hits += l2_hits
+            self.__misses += misses
+
+    def get_mutex(self, key):
+        return self.__remote.get_mutex(key)
+
+    def get(self, key):
+        self._ensure_subscribed()
+        value = self.__local.get(key)
+        if value is not NO_VALUE:
+            self._count(l1_hits=1)
+            return value
+        generation = self.__generation
+        value = self.__remote.get(key)
+        if value is NO_VALUE:
+            self._count(misses=1)
+        else:
+            self._count(l2_hits=1)
+            self._fill(generation, {key: value})
+        return value
+
+    def get_multi(self, keys):
+        self._ensure_subscribed()
+        values = [self.__local.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is NO_VALUE]
+        self._count(l1_hits=len(keys) - len(missing))
+        if missing:
+            generation = self.__generation
+            remote_values = self.__remote.get_multi([keys[i] for i in missing])
+            found = dict()
+            for i, value in zip(missing, remote_values):
+                if value is not NO_VALUE:
+                    found[keys[i]] = value
+                    values[i] = value
+            self._count(l2_hits=len(found), misses=len(missing) - len(found))
+            if found:
+                self._fill(generation, found)
+        return values
+
+    def _fill(self, generation, mapping):
+        # an invalidation during the L2 read may have been applied before the fill
+        if generation == self.__generation:
+            self.__local.set_multi(mapping)
+            # the invalidation may also arrive between the check and the fill
+            if generation != self.__generation:
+                self.__local.delete_multi(list(mapping.keys()))
+
+    def set(self, key, value):
+        self._ensure_subscribed()
+        self.__remote.set(key, value)
+        self.__local.set(key, value)
+        self._publish([key])
+
+    def set_multi(self, mapping):
+        self._ensure_subscribed()
+        self.__remote.set_multi(mapping)
+        self.__local.set_multi(mapping)
+        self._publish(mapping.keys())
+
+    def delete(self, key):
+        self._ensure_subscribed()
+        self.__remote.delete(key)
+        self._invalidated()
+        self.__local.delete(key)
+        self._publish([key])
+
+    def delete_multi(self, keys):
+        self._ensure_subscribed()
+        self.__remote.delete_multi(keys)
+        self._invalidated()
+        self.__local.delete_multi(keys)
+        self._publish(keys)
+
+    def stats(self):
+        """
+        Returns the hit counts and ratios of each layer.  The L2 hit ratio is
+        computed from the requests that missed L1.
+
+        :return: a dict of layer statistics
+        """
+        with self.__counter_lock:
+            l1_hits, l2_hits, misses = self.__l1_hits, self.__l2_hits, self.__misses
+        total = l1_hits + l2_hits + misses
+        l2_total = l2_hits + misses
+        return dict(l1_hits=l1_hits,
+                    l2_hits=l2_hits,
+                    misses=misses,
+                    l1_hit_ratio=float(l1_hits) / total if total else 0.0,
+                    l2_hit_ratio=float(l2_hits) / l2_total if l2_total else 0.0,
+                    hit_ratio=float(l1_hits + l2_hits) / total if total else 0.0)
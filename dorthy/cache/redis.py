@@ -0,0 +1,77 @@
+from dogpile.cache.api import CacheBackend, NO_VALUE
+
+from dorthy import redis
+from dorthy.cache import serializer as cache_serializer, short_mangle_key
+
+
+class RedisBackend(CacheBackend):
+    """
+    A dogpile.cache backend that stores values in redis using the
+    dorthy.redis client.  Multi-key operations are issued as a single
+    command (MGET / DEL) or a non-transactional pipeline.
+
+    Arguments:
+        redis_client: the redis client - defaults to dorthy.redis.client
+        prefix: prefix prepended to all keys
+        redis_expiration_time: server side expiration time in seconds or None
+        serializer: "pickle" (default), "msgpack" or an object with dumps / loads
+        compress_threshold: size in bytes above which values are zlib compressed or None
+        compress_level: the zlib compression level
+        key_mangler: function used to mangle keys - defaults to dorthy.cache.short_mangle_key, None to disable
+        lock_factory: optional mutex factory - e.g. dorthy.redis.lock_factory
+    """
+
+    def __init__(self, arguments):
+        self.__client = arguments.get("redis_client", redis.client)
+        self.__prefix = arguments.get("prefix", None)
+        self.__expire = arguments.get("redis_expiration_time", None)
+        self.__serializer = cache_serializer.get_serializer(arguments.get("serializer", "pickle"))
+        self.__compress_threshold = arguments.get("compress_threshold", 1024)
+        self.__compress_level = arguments.get("compress_level", 6)
+        self.__lock_factory = arguments.get("lock_factory", None)
+        # long generated keys are hashed unless a mangler (or None) is configured
+        self.key_mangler = arguments.get("key_mangler", short_mangle_key)
+
+    @property
+    def client(self):
+        return self.__client
+
+    def _key(self, key):
+        return redis.create_key(self.__prefix, key) if self.__prefix else key
+
+    def _dumps(self, value):
+        return cache_serializer.dumps(self.__serializer, value,
+                                      compress_threshold=self.__compress_threshold,
+                                      compress_level=self.__compress_level)
+
+    def _loads(self, data):
+        return NO_VALUE if data is None else cache_serializer.loads(self.__serializer, data)
+
+    def get_mutex(self, key):
+        return self.__lock_factory(key) if self.__lock_factory else None
+
+    def get(self, key):
+        return self._loads(self.__client.get(self._key(key)))
+
+    def get_multi(self, keys):
+        if not keys:
+            return []
+        return [self._loads(v) for v in self.__client.mget([self._key(k) for k in keys])]
+
+    def set(self, key, value):
+        self.__client.set(self._key(key), self._dumps(value), ex=self.__expire)
+
+    def set_multi(self, mapping):
+        if not mapping:
+            return
+        pipe = self.__client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(self._key(key), self._dumps(value), ex=self.__expire)
+        pipe.execute()
+
+    def delete(self, key):
+        self.__client.delete(self._key(key))
+
+    def delete_multi(self, keys):
+        if keys:
+            self.__client.delete(*[self._key(k) for k in keys])
@@ -0,0 +1,90 @@
+import pickle
+import zlib
+
+from dogpile.cache.api import CachedValue
+
+
+# single byte header prepended to every serialized value
+_RAW = b"\x00"
+_ZLIB = b"\x01"
+
+
+class PickleSerializer(object):
+
+    @staticmethod
+    def dumps(value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(data):
+        return pickle.loads(data)
+
+
+class MsgpackSerializer(object):
+    """
+    Serializes values with msgpack.  Cached values are stored as a
+    (payload, metadata) pair and restored as dogpile CachedValues.  Payloads
+    must be types msgpack can encode.  Requires the msgpack package.
+    """
+
+    def __init__(self):
+        import msgpack
+        self.__msgpack = msgpack
+
+    def dumps(self, value):
+        if isinstance(value, CachedValue):
+            value = [value.payload, value.metadata]
+        return self.__msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        payload, metadata = self.__msgpack.unpackb(data, raw=False)
+        return CachedValue(payload, metadata)
+
+
+def get_serializer(serializer):
+    """
+    Gets the serializer for the given name
+
+    :param serializer: "pickle", "msgpack" or an object with dumps and loads methods
+    :return: a serializer
+    """
+    if serializer is None or serializer == "pickle":
+        return PickleSerializer()
+    elif serializer == "msgpack":
+        return MsgpackSerializer()
+    elif hasattr(serializer, "dumps") and hasattr(serializer, "loads"):
+        return serializer
+    else:
+        raise ValueError("Unsupported cache serializer: {}".format(serializer))
+
+
+def dumps(serializer, value, compress_threshold=None, compress_level=6):
+    """
+    Serializes the value compressing the result if it is larger than the threshold
+
+    :param serializer: the serializer
+    :param value: the value to serialize
+    :param compress_threshold: the size in bytes above which values are compressed or None
+    :param compress_level: the zlib compression level
+    :return: the serialized bytes
+    """
+    data = serializer.dumps(value)
+    if compress_threshold is not None and len(data) > compress_threshold:
+        return _ZLIB + zlib.compress(data, compress_level)
+    return _RAW + data
+
+
+def loads(serializer, data):
+    """
+    Deserializes the bytes created by dumps
+
+    :param serializer: the serializer
+    :param data: the serialized bytes
+    :return: the value
+    """
+    header, body = data[:1], data[1:]
+    if header == _ZLIB:
+        body = zlib.decompress(body)
+    elif header != _RAW:
+        raise ValueError("Invalid serialized cache value header.")
+    return serializer.loads(body)
@@ -0,0 +1,196 @@
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import struct
+import time
+
+from dogpile.cache.api import CacheBackend, NO_VALUE
+
+from dorthy.cache import serializer as cache_serializer
+
+
+logger = logging.getLogger(__name__)
+
+# slot header: state, key hash, written timestamp, expires timestamp, key length, value length
+_HEADER = struct.Struct("<BQddHI")
+
+_EMPTY = 0
+_USED = 1
+
+
+class SharedMemoryBackend(CacheBackend):
+    """
+    A dogpile.cache backend that stores values in a shared memory hash table
+    so that all forked worker processes on a host share a single copy.
+
+    The table is an anonymous (or file backed) mmap of fixed size slots
+    organized as a set associative cache: a key hashes to a bucket of
+    bucket_size consecutive slots and, when the bucket is full, replaces the
+    least recently written slot.  Each bucket is guarded by one of
+    lock_stripes process shared locks.  Values that do not fit in a slot
+    are not cached.
+
+    The backend must be created before the worker processes are forked
+    (e.g. configure the region before tornado.process.fork_processes).
+
+    Arguments:
+        slots: the number of slots (default 4096)
+        slot_size: the size of a slot in bytes including the key (default 4096)
+        bucket_size: the number of slots in a bucket (default 8)
+        lock_stripes: the number of process shared locks (default 64)
+        ttl: the time to live in seconds or None
+        path: optional file to back the table - defaults to anonymous shared memory
+        serializer: "pickle" (default), "msgpack" or an object with dumps / loads
+        compress_threshold: size in bytes above which values are zlib compressed or None
+        lock_factory: optional mutex factory - e.g. dorthy.redis.lock_factory
+    """
+
+    def __init__(self, arguments):
+        self.__slot_size = arguments.get("slot_size", 4096)
+        self.__bucket_size = arguments.get("bucket_size", 8)
+        self.__buckets = max(1, arguments.get("slots", 4096) // self.__bucket_size)
+        self.__ttl = arguments.get("ttl", None)
+        self.__serializer = cache_serializer.get_serializer(arguments.get("serializer", "pickle"))
+        self.__compress_threshold = arguments.get("compress_threshold", 1024)
+        self.__lock_factory = arguments.get("lock_factory", None)
+        self.__locks = [multiprocessing.Lock() for _ in range(arguments.get("lock_stripes", 64))]
+        self.__evictions = 0
+        self.__rejected = 0
+
+        if self.__slot_size <= _HEADER.size:
+            raise ValueError("Shared memory cache slot size must be larger than {}".format(_HEADER.size))
+
+        length = self.__buckets * self.__bucket_size * self.__slot_size
+        path = arguments.get("path", None)
+        if path:
+            with open(path, "a+b") as f:
+                f.truncate(length)
+                self.__memory = mmap.mmap(f.fileno(), length)
+        else:
+            self.__memory = mmap.mmap(-1, length)
+
+    @staticmethod
+    def _hash(key_bytes):
+        return struct.unpack("<Q", hashlib.sha1(key_bytes).digest()[:8])[0]
+
+    def _bucket(self, key_hash):
+        bucket = key_hash % self.__buckets
+        return self.__locks[bucket % len(self.__locks)], bucket * self.__bucket_size
+
+    def _header(self, slot):
+        return _HEADER.unpack_from(self.__memory, slot * self.__slot_size)
+
+    def _find(self, first_slot, key_hash, key_bytes):
+        # returns the slot holding the key or None
+        for slot in range(first_slot, first_slot + self.__bucket_size):
+            state, slot_hash, _, _, key_length, _ = self._header(slot)
+            if state == _USED and slot_hash == key_hash:
+                offset = slot * self.__slot_size + _HEADER.size
+                if self.__memory[offset:offset + key_length] == key_bytes:
+                    return slot
+        return None
+
+    def _read(self, key):
+        key_bytes = key.encode("utf-8")
+        key_hash = self._hash(key_bytes)
+        lock, first_slot = self._bucket(key_hash)
+        with lock:
+            slot = self._find(first_slot, key_hash, key_bytes)
+            if slot is None:
+                return None
+            _, _, _, expires, key_length, value_length = self._header(slot)
+            if expires and expires < time.time():
+                _HEADER.pack_into(self.__memory, slot * self.__slot_size, _EMPTY, 0, 0, 0, 0, 0)
+                return None
+            offset = slot * self.__slot_size + _HEADER.size + key_length
+            return self.__memory[offset:offset + value_length]
+
+    def _write(self, key, value):
+        key_bytes = key.encode("utf-8")
+        data = cache_serializer.dumps(self.__serializer, value, compress_threshold=self.__compress_threshold)
+        key_hash = self._hash(key_bytes)
+        lock, first_slot = self._bucket(key_hash)
+        fits = _HEADER.size + len(key_bytes) + len(data) <= self.__slot_size
+        with lock:
+            slot = self._find(first_slot, key_hash, key_bytes)
+            if not fits:
+                # drop any stale value for the key
+                if slot is not None:
+                    _HEADER.pack_into(self.__memory, slot * self.__slot_size, _EMPTY, 0, 0, 0, 0, 0)
+                self.__rejected += 1
+                logger.debug("Value too large for shared memory cache slot: %s", key)
+                return
+            if slot is None:
+                slot = self._victim(first_slot)
+            now = time.time()
+            offset = slot * self.__slot_size
+            _HEADER.pack_into(self.__memory, offset, _USED, key_hash, now,
+                              now + self.__ttl if self.__ttl else 0, len(key_bytes), len(data))
+            offset += _HEADER.size
+            self.__memory[offset:offset + len(key_bytes)] = key_bytes
+            offset += len(key_bytes)
+            self.__memory[offset:offset + len(data)] = data
+
+    def _victim(self, first_slot):
+        # first empty or expired slot otherwise the least recently written
+        now = time.time()
+        victim = victim_written = None
+        for slot in range(first_slot, first_slot + self.__bucket_size):
+            state, _, written, expires, _, _ = self._header(slot)
+            if state != _USED or (expires and expires < now):
+                return slot
+            if victim is None or written < victim_written:
+                victim, victim_written = slot, written
+        self.__evictions += 1
+        return victim
+
+    def _delete(self, key):
+        key_bytes = key.encode("utf-8")
+        key_hash = self._hash(key_bytes)
+        lock, first_slot = self._bucket(key_hash)
+        with lock:
+            slot = self._find(first_slot, key_hash, key_bytes)
+            if slot is not None:
+                _HEADER.pack_into(self.__memory, slot * self.__slot_size, _EMPTY, 0, 0, 0, 0, 0)
+
+    def get_mutex(self, key):
+        return self.__lock_factory(key) if self.__lock_factory else None
+
+    def get(self, key):
+        data = self._read(key)
+        # deserialize outside of the lock
+        return NO_VALUE if data is None else cache_serializer.loads(self.__serializer, data)
+
+    def get_multi(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        self._write(key, value)
+
+    def set_multi(self, mapping):
+        for key, value in mapping.items():
+            self._write(key, value)
+
+    def delete(self, key):
+        self._delete(key)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self._delete(key)
+
+    def stats(self):
+        """
+        Returns the current size of the table.  Entries are counted across all
+        processes while evictions and rejected values are counted per process.
+
+        :return: a dict with bytes, entries, evictions and rejected counts
+        """
+        entries = used = 0
+        now = time.time()
+        for slot in range(self.__buckets * self.__bucket_size):
+            state, _, _, expires, key_length, value_length = self._header(slot)
+            if state == _USED and not (expires and expires < now):
+                entries += 1
+                used += key_length + value_length
+        return dict(bytes=used, entries=entries, evictions=self.__evictions, rejected=self.__rejected)
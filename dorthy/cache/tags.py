@@ -0,0 +1,188 @@
+import operator
+import threading
+
+from contextlib import contextmanager
+
+from dogpile.cache.api import NO_VALUE
+from dogpile.cache.proxy import ProxyBackend
+
+
+TAG_KEY_PREFIX = "cache:tag"
+
+
+class TaggedValue(tuple):
+    """
+    A cached value stored with the versions of its tags at creation time
+    """
+
+    value = property(operator.itemgetter(0))
+    tags = property(operator.itemgetter(1))
+
+    def __new__(cls, value, tags):
+        return tuple.__new__(cls, (value, tags))
+
+    def __reduce__(self):
+        return TaggedValue, (self.value, self.tags)
+
+
+class LocalTagStore(object):
+    """
+    In-process tag version counters - invalidation is only seen by the current process
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__versions = dict()
+
+    def versions(self, tags):
+        with self.__lock:
+            return [self.__versions.get(tag, 0) for tag in tags]
+
+    def invalidate(self, tag):
+        with self.__lock:
+            self.__versions[tag] = self.__versions.get(tag, 0) + 1
+
+
+class RedisTagStore(object):
+    """
+    Tag version counters stored in redis and shared by all processes
+    """
+
+    def __init__(self, redis_client=None, prefix=TAG_KEY_PREFIX):
+        if redis_client is None:
+            from dorthy import redis
+            redis_client = redis.client
+        self.__client = redis_client
+        self.__prefix = prefix
+
+    def _key(self, tag):
+        return "{}:{}".format(self.__prefix, tag)
+
+    def versions(self, tags):
+        if not tags:
+            return []
+        return [int(v) if v is not None else 0 for v in self.__client.mget([self._key(t) for t in tags])]
+
+    def invalidate(self, tag):
+        self.__client.incr(self._key(tag))
+
+
+_default_store = LocalTagStore()
+
+_pending = threading.local()
+
+
+def set_default_store(store):
+    """
+    Sets the tag store used by proxies and invalidate_tag when none is given
+
+    :param store: a LocalTagStore or RedisTagStore
+    """
+    global _default_store
+    _default_store = store
+
+
+def invalidate_tag(tag, store=None):
+    """
+    Invalidates all cache entries tagged with the tag by incrementing its
+    version counter.  Stale entries are detected lazily when they are read.
+
+    :param tag: the tag - e.g. "account:42"
+    :param store: the tag store or None for the default store
+    """
+    (store or _default_store).invalidate(tag)
+
+
+class TagProxy(ProxyBackend):
+    """
+    A dogpile.cache proxy that stores values set within tagged() with the
+    current versions of their tags.  When read, a value whose tag versions
+    no longer match the store is treated as a miss.  Values set without
+    tags are stored unchanged.  Tagged values must be pickleable.
+    """
+
+    def __init__(self, store=None):
+        super().__init__()
+        self.__store = store
+
+    @property
+    def store(self):
+        return self.__store or _default_store
+
+    def _valid(self, values):
+        tags = set()
+        for value in values:
+            if isinstance(value, TaggedValue):
+                tags.update(value.tags)
+        if not tags:
+            return [v.value if isinstance(v, TaggedValue) else v for v in values]
+        tags = list(tags)
+        current = dict(zip(tags, self.store.versions(tags)))
+        return [(v.value if all(current[t] == version for t, version in v.tags.items()) else NO_VALUE)
+                if isinstance(v, TaggedValue) else v
+                for v in values]
+
+    def _wrap(self, value):
+        tags = getattr(_pending, "tags", None)
+        if not tags:
+            return value
+        versions = getattr(_pending, "versions", None)
+        if versions is None:
+            versions = dict(zip(tags, self.store.versions(tags)))
+        return TaggedValue(value, versions)
+
+    def get(self, key):
+        value = self.proxied.get(key)
+        if value is NO_VALUE:
+            return value
+        return self._valid([value])[0]
+
+    def get_multi(self, keys):
+        return self._valid(self.proxied.get_multi(keys))
+
+    def set(self, key, value):
+        self.proxied.set(key, self._wrap(value))
+
+    def set_multi(self, mapping):
+        self.proxied.set_multi(dict((k, self._wrap(v)) for k, v in mapping.items()))
+
+
+@contextmanager
+def tagged(*tags):
+    """
+    Context manager that tags the values set in the block
+
+        with tagged("account:42"):
+            region.set(key, value)
+    """
+    previous = getattr(_pending, "tags", None), getattr(_pending, "versions", None)
+    _pending.tags = list(tags)
+    _pending.versions = None
+    try:
+        yield
+    finally:
+        _pending.tags, _pending.versions = previous
+
+
+def get_or_create(region, key, creator, tags, store=None, **kwargs):
+    """
+    Calls region.get_or_create tagging a created value with the tags.  The tag
+    versions are read before the creator runs so that an invalidation during
+    creation marks the new value stale.
+
+    :param region: a region wrapped with a TagProxy
+    :param key: the cache key
+    :param creator: the value creation function
+    :param tags: the tags for the value
+    :param store: the tag store of the region's TagProxy or None for the default store
+    :param kwargs: additional keyword arguments for get_or_create
+    :return: the value
+    """
+    tags = list(tags)
+
+    def _creator():
+        _pending.versions = dict(zip(tags, (store or _default_store).versions(tags)))
+        return creator()
+
+    with tagged(*tags):
+        return region.get_or_create(key, _creator, **kwargs)
@@ -0,0 +1,146 @@
+import atexit
+import logging
+import os
+import time
+
+from concurrent.futures import wait
+
+from dogpile.cache.proxy import ProxyBackend
+from tornado.ioloop import PeriodicCallback
+
+from dorthy.background import Executor
+from dorthy.cache import serializer as cache_serializer
+
+
+logger = logging.getLogger(__name__)
+
+_warmups = list()
+
+
+def _concrete_backend(region):
+    backend = region.backend
+    while isinstance(backend, ProxyBackend):
+        backend = backend.proxied
+    return backend
+
+
+def snapshot(region, path):
+    """
+    Writes the contents of a local cache region (LRULocalBackend) to a pickled
+    and compressed file.  The file is replaced atomically so a crash never
+    leaves a partial snapshot.
+
+    :param region: the configured region
+    :param path: the snapshot file path
+    :return: the number of entries written
+    """
+    backend = _concrete_backend(region)
+    if not hasattr(backend, "items"):
+        raise ValueError("Cache backend does not support snapshots: {}".format(type(backend).__name__))
+    items = backend.items()
+    data = cache_serializer.dumps(cache_serializer.PickleSerializer(),
+                                  [[key, value] for key, value in items],
+                                  compress_threshold=0)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    logger.info("Cache snapshot written - entries: %s, path: %s", len(items), path)
+    return len(items)
+
+
+def restore(region, path, max_age=None):
+    """
+    Restores a snapshot into the region.  Entries keep their original creation
+    time so the region's expiration_time still applies.  Call before the
+    server starts accepting traffic.
+
+    :param region: the configured region
+    :param path: the snapshot file path
+    :param max_age: skip the snapshot if the file is older than max_age seconds
+    :return: the number of entries restored
+    """
+    if not os.path.exists(path):
+        return 0
+    if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+        logger.info("Cache snapshot too old, skipping restore: %s", path)
+        return 0
+    try:
+        with open(path, "rb") as f:
+            items = cache_serializer.loads(cache_serializer.PickleSerializer(), f.read())
+    except Exception:
+        logger.exception("Failed to read cache snapshot: %s", path)
+        return 0
+    region.backend.set_multi(dict((key, value) for key, value in items))
+    logger.info("Cache snapshot restored - entries: %s, path: %s", len(items), path)
+    return len(items)
+
+
+def snapshot_on_exit(region, path):
+    """
+    Registers an exit handler that snapshots the region on interpreter shutdown
+    """
+    def _snapshot():
+        try:
+            snapshot(region, path)
+        except Exception:
+            logger.exception("Failed to write cache snapshot on exit: %s", path)
+    atexit.register(_snapshot)
+
+
+def snapshot_periodically(region, path, interval):
+    """
+    Periodically snapshots the region on the IOLoop
+
+    :param interval: the snapshot interval in seconds
+    :return: the started PeriodicCallback
+    """
+    def _snapshot():
+        try:
+            snapshot(region, path)
+        except Exception:
+            logger.exception("Failed to write cache snapshot: %s", path)
+    callback = PeriodicCallback(_snapshot, interval * 1000)
+    callback.start()
+    return callback
+
+
+def warmup(fn):
+    """
+    Decorator that registers a loader function to be run by run_warmups.
+    The loader should populate its regions - e.g. by calling the cached
+    functions for the hot keys.
+
+        @warmup
+        def load_countries():
+            get_countries()
+    """
+    _warmups.append(fn)
+    return fn
+
+
+def run_warmups(loaders=None, timeout=None):
+    """
+    Runs the warm-up loaders in parallel on the background thread executor
+    and waits for them to finish.  Failures are logged and do not stop the
+    remaining loaders.
+
+    :param loaders: the loader functions or None for the registered loaders
+    :param timeout: the maximum number of seconds to wait or None
+    :return: the number of loaders that completed successfully
+    """
+    loaders = list(_warmups if loaders is None else loaders)
+    if not loaders:
+        return 0
+    executor = Executor().get_executor(threaded=True)
+    futures = dict((executor.submit(loader), loader) for loader in loaders)
+    done, not_done = wait(futures, timeout=timeout)
+    completed = 0
+    for future in done:
+        if future.exception() is not None:
+            logger.error("Cache warm-up failed: %s", futures[future].__name__, exc_info=future.exception())
+        else:
+            completed += 1
+    for future in not_done:
+        logger.warn("Cache warm-up did not finish in time: %s", futures[future].__name__)
+    return completed
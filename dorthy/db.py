@@ -1,21 +1,41 @@
+import base64
+import binascii
+import functools
+import json
 import logging
-
+import random
+import re
+import sys
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures.thread import ThreadPoolExecutor
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
 
 from decorator import decorator
 
-from sqlalchemy import orm, create_engine, BigInteger, Column, DateTime, Integer, event, exc, func, String
-from sqlalchemy.pool import Pool
+from tornado.concurrent import chain_future, Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.stack_context import NullContext
+
+from sqlalchemy import and_, bindparam, or_, orm, create_engine, BigInteger, Column, DateTime, Integer, event, exc, func, String
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.pool import Pool, QueuePool
 from sqlalchemy.orm.exc import NoResultFound, StaleDataError
+from sqlalchemy.ext import baked
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.ext.hybrid import Comparator
 from sqlalchemy.types import TypeDecorator, SmallInteger
 
+from dorthy import metrics
 from dorthy.dp import Observable
 from dorthy.enum import DeclarativeEnum
 from dorthy.settings import config
-from dorthy.request import RequestContextManager
+from dorthy.request import RequestContextError, RequestContextManager
 
 
 logger = logging.getLogger(__name__)
@@ -67,24 +87,171 @@ class EnumIntType(TypeDecorator):
     impl = SmallInteger
 
     def __init__(self, values=None):
-        super().__init__(self)
+        super().__init__()
         self.values = values
 
+    @property
+    def values(self):
+        return self.__values
+
+    @values.setter
+    def values(self, values):
+        self.__values = values
+        self.__indexes = dict((v, i) for i, v in enumerate(values)) if values is not None else None
+
     def process_bind_param(self, value, dialect):
-        return None if value is None else self.values.index(value)
+        if value is None:
+            return None
+        try:
+            return self.__indexes[value]
+        except KeyError:
+            raise ValueError("{!r} is not in list".format(value))
 
     def process_result_value(self, value, dialect):
-        return None if value is None else self.values[value]
+        return None if value is None else self.__values[value]
 
 
-def get_enum_values(type_name):
+def _load_enum_values(type_name):
     result = Session().execute("SELECT e.enumlabel " +
                                "FROM pg_enum e " +
                                "JOIN pg_type t ON e.enumtypid = t.oid " +
-                               "WHERE t.typname=:typename", {"typename": type_name}).fetchall()
+                               "WHERE t.typname=:typename " +
+                               "ORDER BY e.enumsortorder", {"typename": type_name}).fetchall()
     return [row[0] for row in result]
 
 
+class LookupCache(object):
+    """
+    In-process cache of LookupMixin tables and postgres enum labels - data
+    that almost never changes.  Tables are loaded whole and indexed by
+    native_code and friendly_name.  Rows are immutable named tuples of the
+    mapped columns, not entities, so they can be shared by all sessions.
+
+    Entries are reloaded on access once they are older than refresh_seconds,
+    by refresh_periodically or after invalidate.  Commits that change a
+    LookupMixin table invalidate it in the committing process.
+    """
+
+    def __init__(self, refresh_seconds=300):
+        """
+        :param refresh_seconds: the age after which entries are reloaded or None to never expire
+        """
+        self.refresh_seconds = refresh_seconds
+        self.__lock = threading.Lock()
+        self.__tables = dict()
+        self.__enums = dict()
+
+    def _expired(self, loaded):
+        return self.refresh_seconds is not None and time.time() - loaded > self.refresh_seconds
+
+    @staticmethod
+    def _load_table(entity_type):
+        session = orm.Session(bind=Session().get_bind())
+        try:
+            columns = [getattr(entity_type, attr.key) for attr in orm.class_mapper(entity_type).column_attrs]
+            rows = session.query(*columns).order_by(entity_type.native_code).all()
+        finally:
+            session.close()
+        by_code = dict((row.native_code, row) for row in rows)
+        by_name = dict((row.friendly_name, row) for row in rows)
+        return time.time(), rows, by_code, by_name
+
+    def _table(self, entity_type):
+        table = self.__tables.get(entity_type)
+        if table is None or self._expired(table[0]):
+            with self.__lock:
+                # another thread may have loaded the table while waiting
+                table = self.__tables.get(entity_type)
+                if table is None or self._expired(table[0]):
+                    table = self.__tables[entity_type] = self._load_table(entity_type)
+        return table
+
+    def preload(self, *entity_types):
+        for entity_type in entity_types:
+            self._table(entity_type)
+
+    def rows(self, entity_type):
+        """
+        :return: the rows of the lookup table ordered by native_code
+        """
+        return list(self._table(entity_type)[1])
+
+    def get(self, entity_type, native_code, default=None):
+        """
+        :return: the row for the native code or the default
+        """
+        return self._table(entity_type)[2].get(native_code, default)
+
+    def get_by_name(self, entity_type, friendly_name, default=None):
+        """
+        :return: the row for the friendly name or the default
+        """
+        return self._table(entity_type)[3].get(friendly_name, default)
+
+    def enum_values(self, type_name):
+        """
+        :return: the labels of the postgres enum type in sort order
+        """
+        entry = self.__enums.get(type_name)
+        if entry is None or self._expired(entry[0]):
+            with self.__lock:
+                entry = self.__enums.get(type_name)
+                if entry is None or self._expired(entry[0]):
+                    entry = self.__enums[type_name] = (time.time(), _load_enum_values(type_name))
+        return list(entry[1])
+
+    def invalidate(self, key=None):
+        """
+        Removes cached entries - they are reloaded on the next access
+
+        :param key: a lookup entity type, an enum type name or None for all entries
+        """
+        with self.__lock:
+            if key is None:
+                self.__tables.clear()
+                self.__enums.clear()
+            else:
+                self.__tables.pop(key, None)
+                self.__enums.pop(key, None)
+
+    def refresh(self):
+        """
+        Reloads all cached lookup tables and enums
+        """
+        for entity_type in list(self.__tables):
+            table = self._load_table(entity_type)
+            with self.__lock:
+                self.__tables[entity_type] = table
+        for type_name in list(self.__enums):
+            entry = (time.time(), _load_enum_values(type_name))
+            with self.__lock:
+                self.__enums[type_name] = entry
+
+    def refresh_periodically(self, interval):
+        """
+        Periodically reloads the cached entries on the IOLoop
+
+        :param interval: the refresh interval in seconds
+        :return: the started PeriodicCallback
+        """
+        def _refresh():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh lookup cache.")
+        callback = PeriodicCallback(_refresh, interval * 1000)
+        callback.start()
+        return callback
+
+
+# Global lookup cache for the application - configured with db.lookup_cache_seconds
+lookups = LookupCache(refresh_seconds=config.db.get("lookup_cache_seconds", 300))
+
+
+def get_enum_values(type_name):
+    return lookups.enum_values(type_name)
+
+
 class TransactionScope(DeclarativeEnum):
     Required = "required"
 
@@ -104,23 +271,238 @@ def transacted_session(**kwargs):
         session.commit()
 
 
-def transactional(scope=TransactionScope.Required):
+@contextmanager
+def read_only_session():
+    """
+    Routes the work in the block to a read replica if replicas are configured
+    and the current request has not written to the primary (read-your-writes).
+    Writes are rejected by replica sessions.
+
+    :return: the session
+    """
+    with Session.routing(read_only=True):
+        yield Session()
+
+
+# postgres serialization_failure and deadlock_detected
+RETRYABLE_PGCODES = frozenset(["40001", "40P01"])
+
+
+def _retryable(e):
+    return getattr(e.orig, "pgcode", None) in RETRYABLE_PGCODES
+
+
+def _run_transactional(f, read_only, args, kwargs, retries=0, backoff=0.05, max_backoff=1.0):
+    attempt = 0
+    while True:
+        # a nested read-write unit of work always runs on the primary
+        with Session.routing(read_only=read_only):
+            session = Session()
+            # only the outermost transaction can be retried
+            outermost = session.transaction is None
+            try:
+                with transacted_session():
+                    return f(*args, **kwargs)
+            except exc.DBAPIError as e:
+                if not outermost or not _retryable(e):
+                    raise
+                name = "{}.{}".format(f.__module__, f.__name__)
+                if attempt >= retries:
+                    if retries:
+                        metrics.incr("db.transaction.retry.exhausted")
+                        metrics.incr("db.transaction.retry.exhausted." + name)
+                    raise
+                # a failed commit leaves the transaction open
+                if session.transaction is not None:
+                    session.rollback()
+                attempt += 1
+                metrics.incr("db.transaction.retry")
+                metrics.incr("db.transaction.retry." + name)
+                logger.info("Retrying transaction %s (%s/%s) after: %s", name, attempt, retries, e.orig)
+        # full jitter exponential backoff
+        time.sleep(random.uniform(0, min(max_backoff, backoff * 2 ** (attempt - 1))))
+
+
+def transactional(scope=TransactionScope.Required, read_only=False, retries=0, backoff=0.05, max_backoff=1.0):
+    """
+    Decorator that runs the function in a transaction - joining the current
+    transaction if there is one.
+
+    The outermost transaction is retried on postgres serialization failures
+    and deadlocks.  The function is called again, so it must not have side
+    effects outside of the database.  Retries sleep the calling thread - use
+    transactional_async for retried units of work on the IOLoop.
+    Retries are counted in the db.transaction.retry.<module>.<function> metrics.
+
+    :param read_only: True to route the work to a read replica
+    :param retries: the maximum number of retries
+    :param backoff: the base backoff in seconds - doubled on every retry and jittered
+    :param max_backoff: the maximum backoff in seconds
+    """
     def _transactional(f, *args, **kwargs):
-        with transacted_session():
-            return f(*args, **kwargs)
+        return _run_transactional(f, read_only, args, kwargs,
+                                  retries=retries, backoff=backoff, max_backoff=max_backoff)
     return decorator(_transactional)
 
 
+_executor = None
+_executor_lock = threading.Lock()
+_executor_thread = threading.local()
+
+_RUN_CONTEXT_KEY = "__db_run_context"
+
+
+def get_executor():
+    """
+    Gets the bounded thread pool used by run.  The number of threads is read
+    from db.executor_threads and defaults to the pool size of the default
+    database so that queued work waits in the executor instead of the pool.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                db_conf = _database_config(DEFAULT_DATABASE)
+                _executor = ThreadPoolExecutor(max_workers=db_conf.get("executor_threads",
+                                                                       db_conf.get("pool_size", 5)))
+    return _executor
+
+
+def run(fn, *args, **kwargs):
+    """
+    Runs a blocking database function on the db executor so that the IOLoop
+    is not blocked.  The function runs in a clone of the active RequestContext
+    so the security context and routing work as usual, but it uses its own
+    session which is closed when the function returns.  Sessions of run do
+    not expire entities on commit - returned entities are detached and must
+    be merged into the request's session to be modified.
+
+        @gen.coroutine
+        def get(self, account_id):
+            account = yield db.run(db.find_by_id, Account, account_id)
+
+    :param fn: the function to run
+    :return: a tornado Future resolving to the result of the function
+    """
+    if getattr(_executor_thread, "active", False):
+        # already on the db executor - waiting on it could deadlock the pool
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+        return future
+
+    context = RequestContextManager.get_context().clone() if RequestContextManager.active() else None
+    if context is not None:
+        context[_RUN_CONTEXT_KEY] = context.id
+        # statements of the unit of work count towards the request
+        context[_QUERY_STATS_KEY] = (context.id, query_stats())
+
+    def _run():
+        _executor_thread.active = True
+        try:
+            if context is None:
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    # do not leak thread local sessions between units of work
+                    Session.remove()
+            # deactivating the clone closes its session
+            with RequestContextManager(context).context_manager():
+                return fn(*args, **kwargs)
+        finally:
+            _executor_thread.active = False
+
+    future = Future()
+    chain_future(get_executor().submit(_run), future)
+    return future
+
+
+def transactional_async(scope=TransactionScope.Required, read_only=False, retries=0, backoff=0.05, max_backoff=1.0):
+    """
+    Like transactional but runs the unit of work on the db executor and
+    returns a tornado Future - see run
+
+        @transactional_async()
+        def update_account(account_id, name):
+            pass
+
+        account = yield update_account(account_id, name)
+    """
+    def _transactional_async(f, *args, **kwargs):
+        return run(_run_transactional, f, read_only, args, kwargs,
+                   retries=retries, backoff=backoff, max_backoff=max_backoff)
+    return decorator(_transactional_async)
+
+
 @transactional()
 def add(entity):
     Session().add(entity)
     return entity
 
 
+# baked queries - configured with db.baked_queries and db.baked_query_cache_size
+_bakery = baked.bakery(size=config.db.get("baked_query_cache_size", 200))
+_baked_queries_enabled = config.db.get("baked_queries", True)
+
+
+def enable_baked_queries(enabled=True):
+    """
+    Turns the baked query cache of the finders on or off - e.g. to compare throughput
+    """
+    global _baked_queries_enabled
+    _baked_queries_enabled = enabled
+
+
+def baked_query(fn):
+    """
+    Decorator for finder queries.  The decorated function receives the session
+    and its positional arguments and builds the query with bindparam
+    placeholders for the values.  The query is constructed and compiled once
+    per function and positional arguments (which must be hashable, e.g. entity
+    types) and the keyword arguments of a call are bound to the placeholders.
+
+        @baked_query
+        def accounts_by_email(session, entity_type):
+            return session.query(entity_type).filter(entity_type.email == bindparam("email"))
+
+        account = accounts_by_email(Account, email=email).first()
+
+    :return: a baked query result (or a Query if baked queries are disabled)
+             supporting all, first, one and iteration
+    """
+    @functools.wraps(fn)
+    def _baked_query(*args, **params):
+        session = Session()
+        if _baked_queries_enabled:
+            query = _bakery(lambda s: fn(s, *args), fn, *args)(session)
+        else:
+            query = fn(session, *args)
+        return query.params(**params) if params else query
+    return _baked_query
+
+
+@baked_query
+def _find_by_id_query(session, entity_type):
+    return session.query(entity_type).filter(entity_type.id == bindparam("entity_id"))
+
+
+@baked_query
+def _find_by_id_versioned_query(session, entity_type):
+    return session.query(entity_type).\
+        filter(entity_type.id == bindparam("entity_id")).\
+        filter(entity_type.version_id == bindparam("version_id"))
+
+
+@baked_query
+def _find_all_query(session, entity_type):
+    return session.query(entity_type)
+
+
 def find_by_id(entity_type, entity_id, not_found_error=True):
     try:
-        return Session().query(entity_type).\
-            filter(entity_type.id == entity_id).one()
+        return _find_by_id_query(entity_type, entity_id=entity_id).one()
     except NoResultFound:
         if not_found_error:
             raise
@@ -129,15 +511,337 @@ def find_by_id(entity_type, entity_id, not_found_error=True):
 
 def find_by_id_versioned(entity_type, entity_id, version_id):
     try:
-        return Session().query(entity_type).\
-            filter(entity_type.id == entity_id).\
-            filter(entity_type.version_id == version_id).one()
+        return _find_by_id_versioned_query(entity_type, entity_id=entity_id, version_id=version_id).one()
     except NoResultFound:
         raise StaleDataError("Entity not found for version - id: {}, version: {}".format(entity_id, version_id))
 
 
 def find_all(entity_type):
-    return Session().query(entity_type).all()
+    return _find_all_query(entity_type).all()
+
+
+def iterate_all(entity_type, batch_size=1000, query=None):
+    """
+    Streams all entities in batches instead of loading the table into memory.
+    Rows are fetched with a server side cursor where the driver supports it
+    (psycopg2) and the connection is held until iteration completes.
+
+    :param entity_type: the entity type
+    :param batch_size: the number of rows fetched and instantiated at a time
+    :param query: optional query to stream - defaults to all entities of the type
+    :return: an iterator of entities
+    """
+    if query is None:
+        query = Session().query(entity_type)
+    return iter(query.execution_options(stream_results=True).yield_per(batch_size))
+
+
+class Page(namedtuple("Page", ["items", "next_cursor"])):
+    """
+    A page of keyset paginated results.  next_cursor is None on the last page.
+    """
+
+    def _as_dict(self):
+        return dict(items=self.items, next_cursor=self.next_cursor)
+
+
+_CURSOR_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def _encode_cursor(values):
+    encoded = []
+    for value in values:
+        if isinstance(value, datetime):
+            value = dict(dt=value.strftime(_CURSOR_DATETIME_FORMAT))
+        elif isinstance(value, date):
+            value = dict(d=value.isoformat())
+        elif isinstance(value, Decimal):
+            value = dict(n=str(value))
+        encoded.append(value)
+    return base64.urlsafe_b64encode(json.dumps(encoded, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor, length):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        if not isinstance(values, list) or len(values) != length:
+            raise ValueError("cursor length")
+        decoded = []
+        for value in values:
+            if isinstance(value, dict):
+                if "dt" in value:
+                    value = datetime.strptime(value["dt"], _CURSOR_DATETIME_FORMAT)
+                elif "d" in value:
+                    value = datetime.strptime(value["d"], "%Y-%m-%d").date()
+                else:
+                    value = Decimal(value["n"])
+            decoded.append(value)
+        return decoded
+    except (KeyError, TypeError, ValueError, UnicodeError, binascii.Error, InvalidOperation):
+        raise ValueError("Invalid pagination cursor.")
+
+
+def paginate(entity_type, limit, cursor=None, order_by=None, descending=False, query=None):
+    """
+    Keyset (seek) pagination - pages are selected with a WHERE clause on the
+    sort columns of the last row instead of OFFSET, so deep pages cost the
+    same as the first one.  The sort columns must be unique together - the
+    primary key is appended when it is not included.
+
+        page = db.paginate(Account, 50, cursor=self.get_argument("cursor", None),
+                           order_by=[Account.created])
+
+    :param entity_type: the entity type
+    :param limit: the page size
+    :param cursor: the opaque cursor of the previous page or None for the first page
+    :param order_by: list of sort columns - defaults to the id
+    :param descending: True to sort all columns descending
+    :param query: optional filtered query of the entity type
+    :return: a Page
+    :raises ValueError: if the cursor is invalid
+    """
+    columns = list(order_by) if order_by else []
+    if not any(c is entity_type.id for c in columns):
+        columns.append(entity_type.id)
+    if query is None:
+        query = Session().query(entity_type)
+
+    if cursor is not None:
+        values = _decode_cursor(cursor, len(columns))
+        # expanded form of (a, b) > (x, y) - row values are not supported everywhere
+        clauses = []
+        for indx, column in enumerate(columns):
+            after = column < values[indx] if descending else column > values[indx]
+            clauses.append(and_(*([c == v for c, v in zip(columns[:indx], values[:indx])] + [after])))
+        query = query.filter(or_(*clauses))
+
+    query = query.order_by(*[c.desc() if descending else c.asc() for c in columns])
+    items = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = _encode_cursor([getattr(last, c.key) for c in columns])
+    return Page(items, next_cursor)
+
+
+_ENTITY_LOADER_KEY = "__db_entity_loader"
+
+
+class EntityLoader(object):
+    """
+    Batches find_by_id lookups.  Pending lookups are resolved with one
+    WHERE id IN (...) query per entity type and the results are cached for
+    the lifetime of the loader (the request).  Lookups return futures that are
+    resolved when the loader dispatches: on the next IOLoop iteration, at the
+    end of a batch_load() block or when find_by_id needs a value.
+
+    The request's session is removed whenever a coroutine handler yields, so
+    cached entities loaded by an earlier activation are merged into the
+    current session (without a query) when they are looked up again.
+    """
+
+    def __init__(self, chunk_size=1000):
+        self.chunk_size = chunk_size
+        self.__cache = dict()
+        self.__pending = dict()
+        self.__scheduled = False
+        self.__batching = 0
+
+    @staticmethod
+    def _coerce_id(entity_type, entity_id):
+        # ids from urls are strings - convert them like the database would
+        try:
+            python_type = entity_type.id.property.columns[0].type.python_type
+        except (AttributeError, NotImplementedError):
+            return entity_id
+        if entity_id is None or isinstance(entity_id, python_type):
+            return entity_id
+        try:
+            return python_type(entity_id)
+        except (TypeError, ValueError):
+            return entity_id
+
+    def _cached(self, entity_type, entity_id):
+        entity = self.__cache[(entity_type, entity_id)]
+        if entity is not None:
+            session = Session()
+            if orm.object_session(entity) is not session:
+                try:
+                    entity = session.merge(entity, load=False)
+                except InvalidRequestError:
+                    # modified in the removed session - load the current row
+                    entity = session.query(entity_type).filter(entity_type.id == entity_id).first()
+                self.__cache[(entity_type, entity_id)] = entity
+        return entity
+
+    def load(self, entity_type, entity_id, not_found_error=True):
+        """
+        Queues a lookup and returns a future for the entity.  Coroutines can
+        yield a list of futures to resolve them with a single query.
+
+        :return: a Future resolving to the entity, None or NoResultFound
+        """
+        future = Future()
+        entity_id = self._coerce_id(entity_type, entity_id)
+        if (entity_type, entity_id) in self.__cache:
+            self._resolve(future, self._cached(entity_type, entity_id), not_found_error)
+        else:
+            self.__pending.setdefault(entity_type, dict()).setdefault(entity_id, []).\
+                append((future, not_found_error))
+            if not self.__batching and not self.__scheduled:
+                # resolve all lookups queued in the current tick together
+                self.__scheduled = True
+                context = RequestContextManager.get_context() if RequestContextManager.active() else None
+                with NullContext():
+                    IOLoop.current().add_callback(self._scheduled_dispatch, context)
+        return future
+
+    def _scheduled_dispatch(self, context):
+        # runs without activating the request context - a deactivation would
+        # remove the session holding the entities before the coroutines resume
+        if RequestContextManager.active():
+            context = None
+        with RequestContextManager.attach(context):
+            try:
+                self.dispatch()
+            except Exception:
+                # the error was delivered to the futures of the failed lookups
+                logger.debug("Failed to load batched entities.", exc_info=True)
+
+    def prime(self, entity_type, entity_ids):
+        """
+        Queues lookups for the ids so that they are loaded in the next dispatch
+        """
+        pending = self.__pending.setdefault(entity_type, dict())
+        for entity_id in entity_ids:
+            entity_id = self._coerce_id(entity_type, entity_id)
+            if (entity_type, entity_id) not in self.__cache:
+                pending.setdefault(entity_id, [])
+
+    def find_by_id(self, entity_type, entity_id, not_found_error=True):
+        """
+        Synchronous lookup - dispatches all pending lookups if the entity is not cached
+        """
+        entity_id = self._coerce_id(entity_type, entity_id)
+        if (entity_type, entity_id) not in self.__cache:
+            self.__pending.setdefault(entity_type, dict()).setdefault(entity_id, [])
+            self.dispatch()
+        entity = self._cached(entity_type, entity_id)
+        if entity is None and not_found_error:
+            raise NoResultFound("No row was found for one()")
+        return entity
+
+    def dispatch(self):
+        """
+        Resolves all pending lookups with one query per entity type (and chunk).
+        If a query fails the futures of its entity type fail, the other entity
+        types are still resolved and the first error is raised.
+        """
+        self.__scheduled = False
+        pending, self.__pending = self.__pending, dict()
+        error = None
+        for entity_type, lookups in pending.items():
+            try:
+                for chunk in _chunks(list(lookups), self.chunk_size):
+                    found = dict((e.id, e) for e in
+                                 Session().query(entity_type).filter(entity_type.id.in_(chunk)))
+                    for entity_id in chunk:
+                        self.__cache[(entity_type, entity_id)] = found.get(entity_id)
+            except Exception as e:
+                if error is None:
+                    error = e
+                for futures in lookups.values():
+                    for future, _ in futures:
+                        future.set_exception(e)
+                continue
+            for entity_id, futures in lookups.items():
+                for future, not_found_error in futures:
+                    self._resolve(future, self.__cache[(entity_type, entity_id)], not_found_error)
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _resolve(future, entity, not_found_error):
+        if entity is None and not_found_error:
+            future.set_exception(NoResultFound("No row was found for one()"))
+        else:
+            future.set_result(entity)
+
+    def clear(self):
+        self.__cache.clear()
+
+    @contextmanager
+    def batch(self):
+        self.__batching += 1
+        try:
+            yield self
+        finally:
+            self.__batching -= 1
+        if not self.__batching:
+            self.dispatch()
+
+
+def entity_loader():
+    """
+    Gets the EntityLoader of the active RequestContext
+
+    :return: the loader or None outside of a request context
+    """
+    if not RequestContextManager.active():
+        return None
+    context = RequestContextManager.get_context()
+    owner, loader = context.get(_ENTITY_LOADER_KEY, (None, None))
+    if owner != context.id:
+        # cloned contexts use their own session - never share entities
+        loader = EntityLoader()
+        context[_ENTITY_LOADER_KEY] = (context.id, loader)
+    return loader
+
+
+@contextmanager
+def batch_load():
+    """
+    Collects the lookups made with load_by_id in the block and resolves them
+    with one query per entity type at the end of the block
+
+        with db.batch_load():
+            futures = [db.load_by_id(Account, account_id) for account_id in ids]
+        accounts = [f.result() for f in futures]
+    """
+    loader = entity_loader()
+    if loader is None:
+        raise RequestContextError("Batch loading requires an active request context.")
+    with loader.batch():
+        yield loader
+
+
+def load_by_id(entity_type, entity_id, not_found_error=True):
+    """
+    Queues a batched lookup in the request's EntityLoader
+
+    :return: a Future resolving to the entity
+    """
+    loader = entity_loader()
+    if loader is None:
+        future = Future()
+        try:
+            future.set_result(find_by_id(entity_type, entity_id, not_found_error=not_found_error))
+        except NoResultFound as e:
+            future.set_exception(e)
+        return future
+    return loader.load(entity_type, entity_id, not_found_error=not_found_error)
+
+
+def batched_find_by_id(entity_type, entity_id, not_found_error=True):
+    """
+    find_by_id that uses the request's EntityLoader cache and resolves
+    pending batched lookups together with this one
+    """
+    loader = entity_loader()
+    if loader is None:
+        return find_by_id(entity_type, entity_id, not_found_error=not_found_error)
+    return loader.find_by_id(entity_type, entity_id, not_found_error=not_found_error)
 
 
 @transactional()
@@ -152,50 +856,452 @@ def delete_versioned(entity_type, entity_id, version_id):
     Session().delete(entity)
 
 
+@transactional()
+def update_versioned(entity_type, entity_id, version_id, **values):
+    """
+    Updates a VersionedMixin entity with a single UPDATE ... WHERE id AND
+    version_id statement instead of loading it first.  The version_id is
+    incremented and UpdateTimestampMixin entities get a new updated timestamp.
+    Entities in the session are synchronized.  ORM events and validate are
+    not run.
+
+    :param entity_type: the entity type
+    :param entity_id: the entity id
+    :param version_id: the expected version
+    :param values: the attribute values to set
+    :return: the new version_id
+    :raises StaleDataError: if no entity with the id and version exists
+    """
+    values["version_id"] = version_id + 1
+    if issubclass(entity_type, UpdateTimestampMixin):
+        values["updated"] = datetime.today()
+    session = Session()
+    count = session.query(entity_type).\
+        filter(entity_type.id == entity_id).\
+        filter(entity_type.version_id == version_id).\
+        update(values, synchronize_session="evaluate")
+    if count != 1:
+        raise StaleDataError("Entity not found for version - id: {}, version: {}".format(entity_id, version_id))
+    Session.notify_versioned_write(session, entity_type, entity_id, version_id)
+    return version_id + 1
+
+
+@transactional()
+def delete_versioned_fast(entity_type, entity_id, version_id):
+    """
+    Deletes a VersionedMixin entity with a single DELETE ... WHERE id AND
+    version_id statement instead of loading it first.  ORM cascades and
+    events are not run.
+
+    :param entity_type: the entity type
+    :param entity_id: the entity id
+    :param version_id: the expected version
+    :raises StaleDataError: if no entity with the id and version exists
+    """
+    session = Session()
+    count = session.query(entity_type).\
+        filter(entity_type.id == entity_id).\
+        filter(entity_type.version_id == version_id).\
+        delete(synchronize_session="evaluate")
+    if count != 1:
+        raise StaleDataError("Entity not found for version - id: {}, version: {}".format(entity_id, version_id))
+    Session.notify_versioned_write(session, entity_type, entity_id, version_id)
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def _chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _prepare_mapping(entity_type, mapping, validate):
+    # apply the defaults the ORM would apply on insert
+    mapping = dict(mapping)
+    if issubclass(entity_type, TimestampMixin) and mapping.get("created") is None:
+        mapping["created"] = datetime.today()
+    if issubclass(entity_type, VersionedMixin) and mapping.get("version_id") is None:
+        mapping["version_id"] = 1
+    if validate and hasattr(entity_type, "validate"):
+        entity_type(**mapping).validate()
+    return mapping
+
+
+def _column_values(entity_type, mapping):
+    # translate mapped attribute names to table columns
+    attrs = entity_type.__mapper__.column_attrs
+    return dict((attrs[key].columns[0], value) for key, value in mapping.items())
+
+
+@transactional()
+def add_all(entities):
+    entities = list(entities)
+    Session().add_all(entities)
+    return entities
+
+
+@transactional()
+def bulk_insert(entity_type, mappings, chunk_size=DEFAULT_CHUNK_SIZE, validate=False):
+    """
+    Inserts rows from dicts keyed by attribute name in chunks without creating
+    entities or running ORM events.  TimestampMixin and VersionedMixin defaults
+    are applied.
+
+    :param entity_type: the entity type
+    :param mappings: an iterable of dicts of attribute values
+    :param chunk_size: the number of rows per statement
+    :param validate: True to call the entity's validate() for each row
+    :return: the number of rows inserted
+    """
+    count = 0
+    session = Session()
+    for chunk in _chunks(mappings, chunk_size):
+        session.bulk_insert_mappings(entity_type, [_prepare_mapping(entity_type, m, validate) for m in chunk])
+        count += len(chunk)
+    return count
+
+
+@transactional()
+def bulk_upsert(entity_type, mappings, index_elements=None, update_columns=None,
+                chunk_size=DEFAULT_CHUNK_SIZE, validate=False):
+    """
+    Inserts or updates rows using Postgres INSERT ... ON CONFLICT DO UPDATE in
+    chunks.  Updated rows get a new updated timestamp (UpdateTimestampMixin) and
+    version (VersionedMixin).  All mappings in a chunk must have the same keys.
+    The ids of the written rows are reported to written listeners (see
+    notify_written) so that cached entities are invalidated on commit.
+
+    :param entity_type: the entity type
+    :param mappings: an iterable of dicts of attribute values
+    :param index_elements: the conflict target attribute names - defaults to the primary key
+    :param update_columns: the attribute names updated on conflict - defaults to all given values
+    :param chunk_size: the number of rows per statement
+    :param validate: True to call the entity's validate() for each row
+    :return: the number of rows inserted or updated
+    """
+    # requires SQLAlchemy 1.1
+    from sqlalchemy.dialects.postgresql import insert
+
+    mapper = entity_type.__mapper__
+    table = mapper.local_table
+    if index_elements is None:
+        conflict_columns = list(mapper.primary_key)
+    else:
+        conflict_columns = [mapper.column_attrs[name].columns[0] for name in index_elements]
+
+    # creation values are never overwritten on conflict
+    preserved = set(conflict_columns)
+    preserved.update(mapper.column_attrs[name].columns[0] for name in ("created", "version_id")
+                     if name in mapper.column_attrs)
+
+    versioned = issubclass(entity_type, VersionedMixin)
+    count = 0
+    session = Session()
+    for chunk in _chunks(mappings, chunk_size):
+        rows = [_column_values(entity_type, _prepare_mapping(entity_type, m, validate)) for m in chunk]
+        stmt = insert(table).values(rows)
+        if update_columns is None:
+            updated = [c for c in rows[0] if c not in preserved]
+        else:
+            updated = [mapper.column_attrs[name].columns[0] for name in update_columns]
+        set_ = dict((c.name, stmt.excluded[c.name]) for c in updated)
+        if issubclass(entity_type, UpdateTimestampMixin):
+            set_[entity_type.updated.property.columns[0].name] = datetime.today()
+        if issubclass(entity_type, VersionedMixin):
+            set_["version_id"] = table.c.version_id + 1
+        if set_:
+            stmt = stmt.on_conflict_do_update(index_elements=conflict_columns, set_=set_)
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=conflict_columns)
+        if not hasattr(entity_type, "id") or not Session.tracks_written:
+            count += session.execute(stmt).rowcount
+            continue
+        if versioned:
+            written = [(row[0], row[1] - 1) for row in
+                       session.execute(stmt.returning(table.c.id, table.c.version_id)).fetchall()]
+        else:
+            written = [(row[0], None) for row in session.execute(stmt.returning(table.c.id)).fetchall()]
+        count += len(written)
+        Session.notify_written(session, entity_type, written)
+    return count
+
+
+@transactional()
+def bulk_delete(entity_type, entity_ids, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Deletes entities by id in chunks with one DELETE ... WHERE id IN (...) per
+    chunk.  Entities are not loaded so ORM cascades and events do not run.
+    The deleted ids are reported to written listeners (see notify_written).
+
+    :param entity_type: the entity type
+    :param entity_ids: an iterable of ids
+    :param chunk_size: the number of ids per statement
+    :return: the number of rows deleted
+    """
+    versioned = issubclass(entity_type, VersionedMixin)
+    table = entity_type.__mapper__.local_table
+    count = 0
+    session = Session()
+    for chunk in _chunks(entity_ids, chunk_size):
+        if not Session.tracks_written:
+            count += session.query(entity_type).\
+                filter(entity_type.id.in_(chunk)).\
+                delete(synchronize_session=False)
+            continue
+        stmt = table.delete().where(table.c.id.in_(chunk))
+        if session.connection().dialect.implicit_returning:
+            if versioned:
+                written = [(row[0], row[1]) for row in
+                           session.execute(stmt.returning(table.c.id, table.c.version_id)).fetchall()]
+            else:
+                written = [(row[0], None) for row in session.execute(stmt.returning(table.c.id)).fetchall()]
+            count += len(written)
+        else:
+            # without RETURNING the versions are read first - they may be stale
+            # if a concurrent transaction updates the rows
+            if versioned:
+                written = session.query(entity_type.id, entity_type.version_id).\
+                    filter(entity_type.id.in_(chunk)).all()
+            else:
+                written = [(entity_id, None) for entity_id in chunk]
+            count += session.execute(stmt).rowcount
+        Session.notify_written(session, entity_type, written)
+    return count
+
+
 class CaseInsensitiveComparator(Comparator):
 
     def __eq__(self, other):
         return func.lower(self.__clause_element__()) == func.lower(other)
 
 
-def _create_engine():
-    # define DB Engine
-    db_conf = config.db
+DEFAULT_DATABASE = "default"
+
+_engines = dict()
+_engines_lock = threading.Lock()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that records the time spent waiting for a connection
+    and the checkouts that required an overflow connection
+    """
+
+    metrics_name = DEFAULT_DATABASE
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.observe("db.{}.pool.checkout_wait".format(self.metrics_name), time.time() - start)
+            if self.overflow() > 0:
+                metrics.incr("db.{}.pool.overflow_checkouts".format(self.metrics_name))
 
-    host = db_conf.host
-    name = db_conf.name
-    port = db_conf.port
-    db_url = "postgresql://{user}:{password}@{host}:{port}/{db}".format(
-        user=db_conf.username,
-        password=db_conf.password,
-        host=host,
-        port=port,
-        db=name)
 
-    return create_engine(db_url,
-                         pool_recycle=900,
-                         echo="debug" if db_conf.enabled("debug") else False,
-                         isolation_level="READ COMMITTED")
+def _database_config(name):
+    if name == DEFAULT_DATABASE:
+        return config.db
+    if "db.databases.{}".format(name) not in config:
+        raise ValueError("Database not configured: {}".format(name))
+    return getattr(config.db.databases, name)
 
 
-def _create_scoped_session(scope_func=None):
+def _create_engine(name=DEFAULT_DATABASE):
+    # define DB Engine
+    db_conf = _database_config(name)
+
+    if db_conf.enabled("url"):
+        db_url = db_conf.url
+    else:
+        db_url = "{driver}://{user}:{password}@{host}:{port}/{db}".format(
+            driver=db_conf.get("driver", "postgresql"),
+            user=db_conf.username,
+            password=db_conf.password,
+            host=db_conf.host,
+            port=db_conf.port,
+            db=db_conf.name)
+
+    connect_args = dict(db_conf.connect_args()) if "connect_args" in db_conf else dict()
+    if db_conf.enabled("statement_timeout"):
+        # postgres statement timeout in milliseconds
+        options = connect_args.get("options", "")
+        connect_args["options"] = "{} -c statement_timeout={}".format(options, db_conf.statement_timeout).strip()
+
+    # pool subclass per database so that pool recreation keeps the metrics name
+    pool_class = type("InstrumentedQueuePool_" + name, (InstrumentedQueuePool,), dict(metrics_name=name))
+
+    engine = create_engine(db_url,
+                           poolclass=pool_class,
+                           pool_size=db_conf.get("pool_size", 5),
+                           max_overflow=db_conf.get("max_overflow", 10),
+                           pool_timeout=db_conf.get("pool_timeout", 30),
+                           pool_recycle=db_conf.get("pool_recycle", 900),
+                           connect_args=connect_args,
+                           echo="debug" if db_conf.enabled("debug") else False,
+                           isolation_level=db_conf.get("isolation_level", "READ COMMITTED"))
+
+    metrics.register_gauge("db.{}.pool.checked_out".format(name), lambda: engine.pool.checkedout())
+    metrics.register_gauge("db.{}.pool.overflow".format(name), lambda: engine.pool.overflow())
+    return engine
+
+
+def get_engine(name=DEFAULT_DATABASE):
+    """
+    Gets the shared engine for the named database.  The default database is
+    configured by config.db and named databases by config.db.databases.<name>.
+    Pool settings: pool_size, max_overflow, pool_timeout, pool_recycle,
+    isolation_level, connect_args and statement_timeout (milliseconds).
+
+    :param name: the database name
+    :return: the engine
+    """
+    if name not in _engines:
+        with _engines_lock:
+            if name not in _engines:
+                _engines[name] = _create_engine(name)
+    return _engines[name]
+
+
+# lag of a postgres hot standby in seconds - NULL on a primary
+DEFAULT_REPLICA_LAG_QUERY = "SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+
+
+class ReplicaSet(object):
+    """
+    Tracks the health and replication lag of the read replicas of a database.
+    Replicas are marked unhealthy for retry_seconds after a disconnect or a
+    failed lag check.  The lag is checked at most every lag_check_interval
+    seconds and replicas lagging more than max_lag seconds are not chosen.
+    """
+
+    def __init__(self, names, max_lag=None, lag_check_interval=10, retry_seconds=30,
+                 lag_query=DEFAULT_REPLICA_LAG_QUERY):
+        self.names = list(names)
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.retry_seconds = retry_seconds
+        self.lag_query = lag_query
+        self.__lock = threading.Lock()
+        # name -> [unhealthy until, lag, lag checked]
+        self.__health = dict((name, [0, 0.0, 0]) for name in self.names)
+        for name in self.names:
+            self._listen(name)
+
+    def _listen(self, name):
+        def _handle_error(context):
+            if context.is_disconnect:
+                self.mark_unhealthy(name)
+        event.listen(get_engine(name), "handle_error", _handle_error)
+        metrics.register_gauge("db.replica.{}.lag".format(name), lambda: self.__health[name][1])
+
+    def mark_unhealthy(self, name):
+        logger.warn("Database replica marked unhealthy: %s", name)
+        metrics.incr("db.replica.{}.unhealthy".format(name))
+        with self.__lock:
+            self.__health[name][0] = time.time() + self.retry_seconds
+
+    def healthy(self, name, now=None):
+        now = time.time() if now is None else now
+        if self.__health[name][0] > now:
+            return False
+        return self.max_lag is None or self._lag(name, now) <= self.max_lag
+
+    def _lag(self, name, now):
+        health = self.__health[name]
+        if now - health[2] > self.lag_check_interval:
+            health[2] = now
+            try:
+                with get_engine(name).connect() as connection:
+                    lag = connection.execute(self.lag_query).scalar()
+                health[1] = float(lag) if lag is not None else 0.0
+            except Exception:
+                logger.exception("Failed to check database replica lag: %s", name)
+                self.mark_unhealthy(name)
+        return health[1]
+
+    def choose(self):
+        """
+        :return: the name of a random healthy replica or None if there is none
+        """
+        now = time.time()
+        candidates = [name for name in self.names if self.healthy(name, now)]
+        return random.choice(candidates) if candidates else None
+
+
+def _create_scoped_session(engine, scope_func=None):
     # autocommit true is used for begin / commit functionality in
     # transactional decorators -- subtransaction support
     # http://docs.sqlalchemy.org/en/rel_0_7/orm/session.html#session-subtransactions
-    return orm.scoped_session(orm.sessionmaker(bind=_create_engine(), autocommit=True), scope_func)
+    return orm.scoped_session(orm.sessionmaker(bind=engine, autocommit=True), scope_func)
+
+
+_ROUTING_KEY_PREFIX = "__db_routing:"
+
+# textual statements that write - compiled statements are flagged by sqlalchemy
+_WRITE_PATTERN = re.compile(r"\s*(?:INSERT|UPDATE|DELETE|MERGE|TRUNCATE|COPY|CREATE|ALTER|DROP|WITH\b.*\b(?:INSERT|UPDATE|DELETE))\b",
+                            re.IGNORECASE | re.DOTALL)
 
 
 class SessionContext(object):
 
-    def __init__(self):
+    def __init__(self, name=DEFAULT_DATABASE):
+        self.name = name
+        # both scopes share the engine (and its pool) of the database
+        engine = get_engine(name)
         self.__request_context_scope = \
-            _create_scoped_session(scope_func=SessionContext._request_context_scope_func)
+            _create_scoped_session(engine, scope_func=self._request_context_scope_func)
         self.__thread_local_scope = \
-            _create_scoped_session()
+            _create_scoped_session(engine)
         self.__observable = Observable()
+        self.__written_observable = Observable()
+        self.__thread_routing = threading.local()
+
+        # read replicas - names of databases configured in db.databases
+        db_conf = _database_config(name)
+        replicas = db_conf.get("replicas", None)
+        if isinstance(replicas, str):
+            replicas = [r.strip() for r in replicas.split(",") if r.strip()]
+        self.__replicas = None
+        self.__replica_scopes = dict()
+        if replicas:
+            self.__replicas = ReplicaSet(replicas,
+                                         max_lag=db_conf.get("max_replica_lag", None),
+                                         lag_check_interval=db_conf.get("replica_lag_check_interval", 10),
+                                         retry_seconds=db_conf.get("replica_retry_seconds", 30),
+                                         lag_query=db_conf.get("replica_lag_query", DEFAULT_REPLICA_LAG_QUERY))
+            for replica in replicas:
+                replica_engine = get_engine(replica)
+                self.__replica_scopes[replica] = (
+                    _create_scoped_session(replica_engine, scope_func=self._request_context_scope_func),
+                    _create_scoped_session(replica_engine))
+            # read-your-writes - statements that bypass the ORM write as well
+            event.listen(engine, "before_cursor_execute", self._track_primary_writes)
+
+        def _request_context_session_release(event, context):
+            # remove sessions on deactivate events
+            if event == "deactivate":
+                try:
+                    self.remove()
+                except:
+                    logger.warn("Failed to remove db session from request context: %s", context.id)
+
+        self._request_context_session_release = _request_context_session_release
 
     def __call__(self, *args, **kwargs):
-        if self.request_context_scoped:
+        replica = self._replica()
+        if replica is not None:
+            scopes = self.__replica_scopes[replica]
+            session = scopes[0]() if self.request_context_scoped else scopes[1]()
+            session.info["replica"] = replica
+        elif self.request_context_scoped:
             session = self.__request_context_scope()
         else:
             session = self.__thread_local_scope()
@@ -205,15 +1311,80 @@ class SessionContext(object):
     def request_context_scoped(self):
         return RequestContextManager.active()
 
+    @property
+    def replicas(self):
+        return self.__replicas
+
     def remove(self):
         if self.request_context_scoped:
             self.__request_context_scope.remove()
+            for scopes in self.__replica_scopes.values():
+                scopes[0].remove()
         else:
             self.__thread_local_scope.remove()
+            for scopes in self.__replica_scopes.values():
+                scopes[1].remove()
+            self.__thread_routing.__dict__.clear()
 
         # call listeners on removed event
         self.__observable("removed", None)
 
+    def _routing_state(self):
+        if self.request_context_scoped:
+            context = RequestContextManager.get_context()
+            key = _ROUTING_KEY_PREFIX + self.name
+            owner, state = context.get(key, (None, None))
+            if owner != context.id:
+                # new or cloned context - clones share the written flag so that
+                # writes of db.run units of work keep the request on the primary
+                state = dict(modes=[], wrote=state["wrote"] if state else threading.Event(), replica=None)
+                context[key] = (context.id, state)
+            return state
+        if not hasattr(self.__thread_routing, "state"):
+            self.__thread_routing.state = dict(modes=[], wrote=threading.Event(), replica=None)
+        return self.__thread_routing.state
+
+    @contextmanager
+    def routing(self, read_only=False):
+        """
+        Marks the work in the block as read-only (routed to a replica) or read-write
+        """
+        if self.__replicas is None:
+            yield
+            return
+        modes = self._routing_state()["modes"]
+        modes.append(read_only)
+        try:
+            yield
+        finally:
+            modes.pop()
+
+    def _in_primary_transaction(self):
+        scope = self.__request_context_scope if self.request_context_scoped else self.__thread_local_scope
+        return scope.registry.has() and scope().transaction is not None
+
+    def _replica(self):
+        if self.__replicas is None:
+            return None
+        state = self._routing_state()
+        if not state["modes"] or not state["modes"][-1] or state["wrote"].is_set() or self._in_primary_transaction():
+            return None
+        replica = state["replica"]
+        if replica is None or not self.__replicas.healthy(replica):
+            replica = state["replica"] = self.__replicas.choose()
+            if replica is None:
+                metrics.incr("db.replica.fallback")
+        return replica
+
+    def _mark_written(self):
+        if self.__replicas is not None:
+            self._routing_state()["wrote"].set()
+
+    def _track_primary_writes(self, conn, cursor, statement, parameters, context, executemany):
+        # stick to the primary after writing
+        if context.isinsert or context.isupdate or context.isdelete or _WRITE_PATTERN.match(statement):
+            self._mark_written()
+
     def _init_session(self, session):
 
         # add register after commit method to the session
@@ -221,27 +1392,51 @@ class SessionContext(object):
             session.after_commit_callbacks = []
             session.register_after_commit = lambda cb, handle_error=False: \
                 session.after_commit_callbacks.append((cb, handle_error))
+            session.info["session_context"] = self
+
+        # sessions of db.run are closed before their entities are returned
+        if RequestContextManager.active() and \
+                RequestContextManager.get_context().get(_RUN_CONTEXT_KEY) == RequestContextManager.get_context().id:
+            session.expire_on_commit = False
 
         # call listeners on created event
         self.__observable("created", session)
 
         return session
 
-    @staticmethod
-    def _request_context_scope_func():
+    def _request_context_scope_func(self):
         request_context = RequestContextManager.get_context()
-        if not request_context.contains_listener(SessionContext._request_context_session_release):
-            request_context.register_listener(SessionContext._request_context_session_release)
+        if not request_context.contains_listener(self._request_context_session_release):
+            request_context.register_listener(self._request_context_session_release)
         return request_context.id
 
-    @staticmethod
-    def _request_context_session_release(event, context):
-        # remove sessions on deactivate events
-        if event == "deactivate":
-            try:
-                Session.remove()
-            except:
-                logger.warn("Failed to remove db session from request context: %s", context.id)
+    @property
+    def tracks_written(self):
+        """
+        True if listeners are registered for rows written by bulk statements -
+        the written rows are not collected otherwise
+        """
+        return len(self.__written_observable) > 0
+
+    def register_written_listener(self, listener):
+        self.__written_observable.register(listener)
+
+    def notify_written(self, session, entity_type, written):
+        """
+        Notifies written listeners of rows written by a bulk statement - e.g.
+        so caches can invalidate them.  Listeners are called with the session,
+        the entity_type and a list of (entity_id, version_id) tuples where
+        version_id is None for entities that are not versioned.
+        """
+        self.__written_observable(session, entity_type, written)
+
+    def notify_versioned_write(self, session, entity_type, entity_id, version_id):
+        """
+        Notifies listeners of a versioned entity written by a statement - e.g.
+        so caches can invalidate it.  Listeners receive a versioned_write event
+        with a (session, entity_type, entity_id, version_id) tuple.
+        """
+        self.__observable("versioned_write", (session, entity_type, entity_id, version_id))
 
     def contains_listener(self, listener):
         return listener in self.__observable
@@ -276,12 +1471,66 @@ def set_events(mapper, cls):
         event.listen(cls, "before_insert", validator)
 
 
+class PingStrategy(DeclarativeEnum):
+    Always = "always"
+    Idle = "idle"
+    OnError = "on_error"
+
+
+# liveness check on pool checkout - configured with db.ping_strategy
+#   always: ping on every checkout
+#   idle: ping if the connection was idle longer than db.ping_idle_seconds or after an error
+#   on_error: ping only connections that have not been checked since the last database error
+_ping_strategy = PingStrategy.convert(config.db.get("ping_strategy", PingStrategy.Always.value))
+_ping_idle_seconds = config.db.get("ping_idle_seconds", 30)
+_last_error = 0
+
+
+def _ping_required(connection_record, now):
+    if _ping_strategy == PingStrategy.Always:
+        return True
+    if connection_record.info.get("pinged", 0) < _last_error:
+        return True
+    if _ping_strategy == PingStrategy.Idle:
+        return now - connection_record.info.get("last_used", 0) > _ping_idle_seconds
+    return False
+
+
+@event.listens_for(Pool, "connect")
+def _record_connect(dbapi_connection, connection_record):
+    now = time.time()
+    connection_record.info["last_used"] = now
+    connection_record.info["pinged"] = now
+
+
+@event.listens_for(Pool, "checkin")
+def _record_checkin(dbapi_connection, connection_record):
+    if connection_record is not None:
+        connection_record.info["last_used"] = time.time()
+
+
+@event.listens_for(Engine, "handle_error")
+def _record_error(context):
+    # only disconnects say anything about the liveness of pooled connections -
+    # not e.g. integrity or serialization failures
+    global _last_error
+    if context.is_disconnect:
+        _last_error = time.time()
+
+
 @event.listens_for(Pool, "checkout")
 def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    now = time.time()
+    if not _ping_required(connection_record, now):
+        metrics.incr("db.ping.skipped")
+        return
+
+    metrics.incr("db.ping.count")
     cursor = dbapi_connection.cursor()
     try:
         cursor.execute("SELECT 1")
     except:
+        metrics.incr("db.ping.failures")
         # optional - dispose the whole pool
         # instead of invalidating one at a time
         # connection_proxy._pool.dispose()
@@ -291,6 +1540,182 @@ def ping_connection(dbapi_connection, connection_record, connection_proxy):
         raise exc.DisconnectionError()
     else:
         cursor.close()
+        connection_record.info["pinged"] = time.time()
+    finally:
+        metrics.observe("db.ping.latency", time.time() - now)
+
+
+# statement instrumentation
+#   db.slow_query_seconds: log statements slower than this - 0 disables logging
+#   db.n_plus_one_threshold: log statement shapes repeated this often in a request - 0 disables logging
+_slow_query_seconds = config.db.get("slow_query_seconds", 1.0)
+_n_plus_one_threshold = config.db.get("n_plus_one_threshold", 10)
+
+_QUERY_STATS_KEY = "__db_query_stats"
+
+_LITERAL_PATTERN = re.compile(r"%\(\w+\)s|%s|\?|(?<!:):\w+|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LIST_PATTERN = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE_PATTERN = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_statement(statement):
+    """
+    Reduces a statement to its shape - parameters and literals are replaced
+    with ? and lists of parameters are collapsed
+    """
+    statement = _LITERAL_PATTERN.sub("?", statement)
+    statement = _LIST_PATTERN.sub("(?)", statement)
+    return _SPACE_PATTERN.sub(" ", statement).strip()
+
+
+class QueryStats(object):
+    """
+    Statements executed in a request - the count, total duration in seconds
+    and [count, duration] per statement shape
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = dict()
+        self.reported = False
+        # units of work of db.run record from executor threads
+        self.__lock = threading.Lock()
+
+    def record(self, statement, duration):
+        with self.__lock:
+            self.count += 1
+            self.duration += duration
+            shape = self.shapes.get(statement)
+            if shape is None:
+                self.shapes[statement] = [1, duration]
+            else:
+                shape[0] += 1
+                shape[1] += duration
+
+    def repeated(self, threshold):
+        """
+        Gets the normalized statements executed at least threshold times
+
+        :return: a list of (statement, count, duration) sorted by count
+        """
+        shapes = dict()
+        with self.__lock:
+            recorded = list(self.shapes.items())
+        for statement, (count, duration) in recorded:
+            shape = shapes.setdefault(normalize_statement(statement), [0, 0.0])
+            shape[0] += count
+            shape[1] += duration
+        return sorted(((s, c, d) for s, (c, d) in shapes.items() if c >= threshold),
+                      key=lambda r: r[1], reverse=True)
+
+
+def query_stats():
+    """
+    Gets the statement stats of the active request.  The stats are kept for
+    the whole request - across coroutine yields and units of work of db.run.
+
+    :return: the QueryStats or None outside of a request context
+    """
+    if not RequestContextManager.active():
+        return None
+    context = RequestContextManager.get_context()
+    owner, stats = context.get(_QUERY_STATS_KEY, (None, None))
+    if owner != context.id:
+        stats = QueryStats()
+        context[_QUERY_STATS_KEY] = (context.id, stats)
+    return stats
+
+
+def report_query_stats():
+    """
+    Reports the statement stats of the active request - the statement count
+    and duration metrics and possible N+1 queries.  Call once when the
+    request finishes - BaseHandler.finish does for web requests.
+
+    :return: the reported QueryStats or None if there are none or they were already reported
+    """
+    if not RequestContextManager.active():
+        return None
+    context = RequestContextManager.get_context()
+    owner, stats = context.get(_QUERY_STATS_KEY, (None, None))
+    if owner != context.id or stats is None or stats.reported:
+        return None
+    # kept so that statements executed after the report are recognized as late
+    stats.reported = True
+    metrics.observe("db.request.statements", stats.count)
+    metrics.observe("db.request.duration", stats.duration)
+    if _n_plus_one_threshold:
+        for statement, count, duration in stats.repeated(_n_plus_one_threshold):
+            metrics.incr("db.request.n_plus_one")
+            logger.warning("Possible N+1 query - executed %s times in %.3fs: %s", count, duration, statement)
+    return stats
+
+
+def server_timing():
+    """
+    Formats the statement stats of the active request as a Server-Timing entry
+
+    :return: the entry - e.g. db;dur=12.5;desc="4 queries" - or None
+    """
+    stats = query_stats()
+    if not stats or not stats.count:
+        return None
+    return 'db;dur={:.1f};desc="{} queries"'.format(stats.duration * 1000, stats.count)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.time())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.time() - conn.info["query_start_time"].pop()
+    metrics.observe("db.statement.duration", duration)
+    if _slow_query_seconds and duration >= _slow_query_seconds:
+        metrics.incr("db.statement.slow")
+        logger.warning("Slow query - %.3fs: %s", duration, normalize_statement(statement))
+    stats = query_stats()
+    if stats is not None:
+        # statements are normalized lazily - most requests are never reported
+        stats.record(statement, duration)
+        if stats.reported:
+            metrics.incr("db.request.late_statements")
+            logger.info("Statement executed after the request stats were reported: %s",
+                        normalize_statement(statement))
+
+
+@event.listens_for(Engine, "handle_error")
+def _discard_start_time(context):
+    # after_cursor_execute is not called for failed statements
+    start_times = context.connection.info.get("query_start_time") if context.connection is not None else None
+    if start_times:
+        start_times.pop()
+
+
+@event.listens_for(orm.Session, "before_flush")
+def reject_replica_writes(session, flush_context, instances):
+    if session.info.get("replica") and (session.new or session.dirty or session.deleted):
+        raise InvalidRequestError("Cannot write using a read replica session: {}".format(session.info["replica"]))
+
+
+@event.listens_for(orm.Session, "after_flush")
+def invalidate_lookups(session, flush_context):
+    changed = set(type(obj) for obj in session.new | session.dirty | session.deleted if isinstance(obj, LookupMixin))
+    if not changed:
+        return
+
+    def _invalidate():
+        for entity_type in changed:
+            lookups.invalidate(entity_type)
+
+    # sessions created by db.Session provide after commit callbacks
+    if hasattr(session, "register_after_commit"):
+        session.register_after_commit(_invalidate, handle_error=True)
+    else:
+        _invalidate()
 
 
 @event.listens_for(orm.Session, "after_commit")
@@ -92,6 +92,9 @@ class Observable(object):
         if errors:
             raise MultipleObservableErrors("Failed to execute observable callbacks.", errors)
 
+    def __len__(self):
+        return len(self.__listeners)
+
     def __contains__(self, item):
         if inspect.isfunction(item) or inspect.ismethod(item):
             return id(item) in self.__listeners
@@ -0,0 +1,125 @@
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsRegistry(object):
+    """
+    A simple thread safe in-process registry of counters, timings and gauges.
+    Counters are monotonically increasing values.  Timings record the
+    count, total and max of observed values (e.g. latency in seconds).
+    Gauges are functions evaluated when a snapshot is taken.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = dict()
+        self.__timings = dict()
+        self.__gauges = dict()
+
+    def incr(self, name, amount=1):
+        """
+        Increments the counter with the given name
+
+        :param name: the counter name
+        :param amount: the amount to increment by
+        """
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        """
+        Records an observed value for the timing with the given name
+
+        :param name: the timing name
+        :param value: the observed value
+        """
+        with self.__lock:
+            timing = self.__timings.get(name)
+            if timing is None:
+                self.__timings[name] = [1, value, value]
+            else:
+                timing[0] += 1
+                timing[1] += value
+                if value > timing[2]:
+                    timing[2] = value
+
+    def register_gauge(self, name, func):
+        """
+        Registers a gauge function that returns the current value of the gauge
+
+        :param name: the gauge name
+        :param func: a function without arguments returning the gauge value
+        """
+        with self.__lock:
+            self.__gauges[name] = func
+
+    def counter(self, name):
+        """
+        Gets the current value of the counter with the given name
+
+        :param name: the counter name
+        :return: the counter value or 0 if it has not been incremented
+        """
+        with self.__lock:
+            return self.__counters.get(name, 0)
+
+    def snapshot(self, prefix=None):
+        """
+        Creates a point in time copy of the registered metrics
+
+        :param prefix: only include metrics whose name starts with the prefix
+        :return: a dict with counters, timings and gauges
+        """
+        with self.__lock:
+            counters = dict((k, v) for k, v in self.__counters.items()
+                            if prefix is None or k.startswith(prefix))
+            timings = dict((k, dict(count=v[0], total=v[1], max=v[2], avg=v[1] / v[0]))
+                           for k, v in self.__timings.items()
+                           if prefix is None or k.startswith(prefix))
+            gauge_funcs = [(k, v) for k, v in self.__gauges.items()
+                           if prefix is None or k.startswith(prefix)]
+
+        # gauges are evaluated outside of the lock - they may take locks of their own
+        gauges = dict()
+        for name, func in gauge_funcs:
+            try:
+                gauges[name] = func()
+            except Exception:
+                logger.exception("Failed to evaluate metrics gauge: %s", name)
+        return dict(counters=counters, timings=timings, gauges=gauges)
+
+    def reset(self, gauges=False):
+        """
+        Clears the counters and timings.  Gauges report live values and are
+        kept unless gauges is True.
+
+        :param gauges: True to also remove the registered gauges
+        """
+        with self.__lock:
+            self.__counters.clear()
+            self.__timings.clear()
+            if gauges:
+                self.__gauges.clear()
+
+
+# Global registry for the application
+registry = MetricsRegistry()
+
+
+def incr(name, amount=1):
+    registry.incr(name, amount)
+
+
+def observe(name, value):
+    registry.observe(name, value)
+
+
+def snapshot(prefix=None):
+    return registry.snapshot(prefix)
+
+
+def register_gauge(name, func):
+    registry.register_gauge(name, func)
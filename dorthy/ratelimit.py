@@ -0,0 +1,215 @@
+import logging
+import math
+import threading
+import time
+
+from cachetools import LRUCache
+from decorator import decorator
+
+from dorthy import metrics, redis
+
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_PREFIX = "ratelimit"
+
+# seconds between logged redis failures - every failure is counted in metrics
+ERROR_LOG_INTERVAL = 60
+
+# Generic cell rate algorithm (GCRA).  Stores the theoretical arrival time (TAT)
+# of the next request.  A request is allowed if it does not arrive earlier than
+# TAT - window, which permits bursts of up to limit requests per window.
+#
+# The current time is read from the redis server so that all hosts share one
+# clock - clock skew between hosts would shift the TAT.  TIME is not
+# deterministic so redis before 5 must replicate the effects of the script.
+#
+# KEYS[1] - the rate limit key
+# ARGV[1] - the emission interval in seconds (window / limit)
+# ARGV[2] - the window in seconds
+#
+# returns {allowed, retry_after, remaining}
+_GCRA_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local interval = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]))
+if not tat or tat < now then
+    tat = now
+end
+local new_tat = tat + interval
+local allow_at = new_tat - window
+if now < allow_at then
+    return {0, tostring(allow_at - now), 0}
+end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil((new_tat - now) * 1000))
+return {1, '0', math.floor((window - (new_tat - now)) / interval)}
+"""
+
+redis.scripts.register("gcra", _GCRA_SCRIPT)
+
+
+class TokenBucket(object):
+    """
+    A local token bucket that holds up to capacity tokens and refills
+    at the given rate (tokens per second).
+    """
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.__tokens = float(capacity)
+        self.__updated = time.time()
+
+    def acquire(self, now=None):
+        """
+        Acquires a token from the bucket
+
+        :param now: the current time in seconds
+        :return: 0 if a token was acquired, otherwise the seconds until a token is available
+        """
+        now = time.time() if now is None else now
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+        if self.__tokens >= 1:
+            self.__tokens -= 1
+            return 0
+        return (1 - self.__tokens) / self.rate
+
+
+class RateLimiter(object):
+    """
+    Sliding window rate limiter backed by redis using GCRA.  The check
+    is a single atomic round trip.  Optionally a local token bucket per key
+    with the same limit rejects requests for hot keys without a round trip:
+    if this process alone has exceeded the limit then the global limit has
+    been exceeded as well.
+    """
+
+    def __init__(self, name, limit, window, local_bucket=True, local_maxsize=1024, fail_open=True):
+        if limit <= 0 or window <= 0:
+            raise ValueError("Rate limit and window must be greater than zero.")
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.fail_open = fail_open
+        self.__interval = float(window) / limit
+        self.__local_buckets = LRUCache(local_maxsize) if local_bucket else None
+        self.__lock = threading.Lock()
+        self.__errors_logged_at = None
+        self.__errors_suppressed = 0
+
+    def _local_acquire(self, key, now):
+        with self.__lock:
+            bucket = self.__local_buckets.get(key)
+            if bucket is None:
+                bucket = self.__local_buckets[key] = TokenBucket(self.limit, self.limit / float(self.window))
+            return bucket.acquire(now)
+
+    def check(self, key):
+        """
+        Checks whether a request for the given key is allowed
+
+        :param key: the rate limit key
+        :return: a tuple of (allowed, retry_after) where retry_after is in seconds
+        """
+        now = time.time()
+        if self.__local_buckets is not None:
+            retry_after = self._local_acquire(key, now)
+            if retry_after:
+                metrics.incr("ratelimit.{}.rejected.local".format(self.name))
+                self._rejected()
+                return False, retry_after
+
+        redis_key = redis.create_key(RATE_LIMIT_PREFIX, "{}:{}".format(self.name, key))
+        try:
+            allowed, retry_after, _ = redis.scripts.execute("gcra",
+                                                            keys=[redis_key],
+                                                            args=[self.__interval, self.window])
+        except Exception as e:
+            metrics.incr("ratelimit.{}.errors".format(self.name))
+            self._log_error(redis_key, e, now)
+            return self.fail_open, 0 if self.fail_open else self.window
+
+        self._succeeded()
+        if allowed:
+            metrics.incr("ratelimit.{}.allowed".format(self.name))
+            return True, 0
+        else:
+            self._rejected()
+            return False, float(retry_after)
+
+    def _log_error(self, redis_key, e, now):
+        # a redis outage fails every check - log the first failure with a
+        # traceback and then a summary at most every ERROR_LOG_INTERVAL seconds
+        with self.__lock:
+            first = self.__errors_logged_at is None
+            if not first and now - self.__errors_logged_at < ERROR_LOG_INTERVAL:
+                self.__errors_suppressed += 1
+                return
+            suppressed, self.__errors_suppressed = self.__errors_suppressed, 0
+            self.__errors_logged_at = now
+        if first:
+            logger.exception("Failed to check rate limit for: %s", redis_key)
+        else:
+            logger.warning("Failed to check rate limit for: %s (%s more failures since the last log): %s",
+                           redis_key, suppressed, e)
+
+    def _succeeded(self):
+        # the next failure is logged with a traceback again
+        if self.__errors_logged_at is not None:
+            with self.__lock:
+                self.__errors_logged_at = None
+                self.__errors_suppressed = 0
+
+    def _rejected(self):
+        metrics.incr("ratelimit.{}.rejected".format(self.name))
+        metrics.incr("ratelimit.rejected")
+
+
+def rate_limited(key_func, limit, window, name=None, local_bucket=True, local_maxsize=1024, fail_open=True):
+    """
+    Decorator to rate limit a BaseHandler method to limit requests per
+    window (seconds) for each key returned by the key function.  Rejected
+    requests receive a 429 response with a Retry-After header.
+
+        @rate_limited(lambda handler: handler.client_ip, 10, 60)
+        def post(self):
+            pass
+
+    :param key_func: a function that receives the handler and returns the rate limit key
+    :param limit: the number of requests allowed per window
+    :param window: the window in seconds
+    :param name: the limiter name used for keys and metrics - defaults to the method name
+    :param local_bucket: True to reject hot keys locally without a redis round trip
+    :param local_maxsize: the maximum number of local buckets
+    :param fail_open: True to allow requests if redis is unavailable
+    """
+
+    limiters = dict()
+
+    def _get_limiter(f):
+        limiter_name = name if name is not None else "{}.{}".format(f.__module__, f.__qualname__)
+        if limiter_name not in limiters:
+            limiters[limiter_name] = RateLimiter(limiter_name, limit, window,
+                                                 local_bucket=local_bucket,
+                                                 local_maxsize=local_maxsize,
+                                                 fail_open=fail_open)
+        return limiters[limiter_name]
+
+    def _rate_limited(f, handler, *args, **kwargs):
+        allowed, retry_after = _get_limiter(f).check(key_func(handler))
+        if not allowed:
+            handler.set_status(429)
+            handler.set_header("Retry-After", str(int(math.ceil(retry_after))))
+            handler.write_error(429)
+            if not handler.finished:
+                handler.finish()
+            return
+        return f(handler, *args, **kwargs)
+
+    return decorator(_rate_limited)
@@ -1,15 +1,293 @@
+import logging
 import redis
+import threading
 import time
 
+from uuid import uuid4
+
+from decorator import decorator
+
 from dorthy.settings import config
 from dorthy.utils import native_str
 
 
+logger = logging.getLogger(__name__)
+
+LOCK_PREFIX = "lock"
+
 client = redis.StrictRedis(host=config.redis.server,
                            port=config.redis.port,
                            db=config.redis.db)
 
 
+class ScriptRegistry(object):
+    """
+    Registry of server side Lua scripts.  Scripts are registered once
+    by name and executed with EVALSHA so that only the script digest
+    travels over the wire.  If the server does not know the script
+    (NOSCRIPT - e.g. after a restart or SCRIPT FLUSH) it is loaded and
+    the call is retried transparently.  Scripts executed on a pipeline
+    are loaded when the pipeline is executed.
+    """
+
+    def __init__(self, redis_client):
+        self.__client = redis_client
+        self.__scripts = dict()
+
+    def __contains__(self, name):
+        return name in self.__scripts
+
+    def register(self, name, source):
+        """
+        Registers a Lua script under the given name
+
+        :param name: the script name
+        :param source: the Lua source of the script
+        :return: the registered script
+        """
+        script = self.__client.register_script(source)
+        self.__scripts[name] = script
+        return script
+
+    def get(self, name):
+        """
+        Gets the script registered under the given name
+
+        :param name: the script name
+        :return: the script
+        :raises KeyError: no script is registered for the name
+        """
+        try:
+            return self.__scripts[name]
+        except KeyError:
+            raise KeyError("No redis script registered for name: {}".format(name))
+
+    def load(self):
+        """
+        Loads all registered scripts into the script cache of the server
+        so that the first execution does not pay for a NOSCRIPT round trip.
+        """
+        scripts = list(self.__scripts.values())
+        if not scripts:
+            return
+        exists = self.__client.script_exists(*[s.sha for s in scripts])
+        for script, loaded in zip(scripts, exists):
+            if not loaded:
+                script.sha = self.__client.script_load(script.script)
+
+    def execute(self, name, keys=None, args=None, pipe=None):
+        """
+        Executes the script registered under the given name
+
+        :param name: the script name
+        :param keys: the keys passed to the script (KEYS)
+        :param args: the arguments passed to the script (ARGV)
+        :param pipe: the pipe to use for the operation
+        :return: the script return value
+        """
+        script = self.get(name)
+        return script(keys=keys or [], args=args or [], client=pipe if pipe is not None else self.__client)
+
+
+# increments a key and sets its expiration when the key is created
+_INCRBY_EXPIRE_SCRIPT = """
+local value = redis.call('INCRBY', KEYS[1], ARGV[1])
+local expire = tonumber(ARGV[2])
+if expire and expire > 0 and redis.call('TTL', KEYS[1]) < 0 then
+    redis.call('EXPIRE', KEYS[1], expire)
+end
+return value
+"""
+
+# sets a key only if its current value matches the expected value
+_COMPARE_AND_SET_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    local expire = tonumber(ARGV[3])
+    if expire and expire > 0 then
+        redis.call('SET', KEYS[1], ARGV[2], 'EX', expire)
+    else
+        redis.call('SET', KEYS[1], ARGV[2])
+    end
+    return 1
+end
+return 0
+"""
+
+# deletes a key only if its current value matches the expected value
+_COMPARE_AND_DELETE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# pushes a value onto a list trimming the list to the max length
+_PUSH_CAPPED_SCRIPT = """
+redis.call('LPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+local expire = tonumber(ARGV[3])
+if expire and expire > 0 then
+    redis.call('EXPIRE', KEYS[1], expire)
+end
+return redis.call('LLEN', KEYS[1])
+"""
+
+# resets the expiration of a key only if its current value matches the expected value
+_COMPARE_AND_PEXPIRE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+scripts = ScriptRegistry(client)
+scripts.register("incrby_expire", _INCRBY_EXPIRE_SCRIPT)
+scripts.register("compare_and_set", _COMPARE_AND_SET_SCRIPT)
+scripts.register("compare_and_delete", _COMPARE_AND_DELETE_SCRIPT)
+scripts.register("push_capped", _PUSH_CAPPED_SCRIPT)
+scripts.register("compare_and_pexpire", _COMPARE_AND_PEXPIRE_SCRIPT)
+
+
+class LockError(Exception):
+    pass
+
+
+class Lock(object):
+    """
+    A distributed lock held as a redis key with a time to live (lease).
+    Each acquisition stores a unique token so that only the owner can
+    release or extend the lock - an expired lease that has been acquired
+    by another process is never released by the previous owner.
+
+    The acquire / release interface is compatible with the dogpile.cache
+    mutex interface so that locks can be returned by a backend's get_mutex.
+    A lock may be released by another thread than the one that acquired it -
+    dogpile's async_creation_runner hands the mutex to a creation thread.
+    """
+
+    def __init__(self, name, ttl, blocking=True, timeout=None, sleep=0.1, redis_client=client,
+                 raise_on_release=True):
+        """
+        :param name: the redis key for the lock
+        :param ttl: the lease time in seconds
+        :param blocking: True to wait for the lock when acquired, False to return immediately
+        :param timeout: the maximum number of seconds to wait for the lock or None to wait forever
+        :param sleep: the number of seconds to sleep between acquisition attempts
+        :param redis_client: the redis client to use
+        :param raise_on_release: False to log instead of raising when releasing an expired lease
+        """
+        self.name = name
+        self.ttl = ttl
+        self.blocking = blocking
+        self.timeout = timeout
+        self.sleep = sleep
+        self.raise_on_release = raise_on_release
+        self.__client = redis_client
+        # tokens of the current acquisitions - the acquiring thread's token is
+        # also thread local so that each thread releases its own acquisition
+        self.__local = threading.local()
+        self.__tokens = []
+        self.__tokens_lock = threading.Lock()
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockError("Failed to acquire lock: {}".format(self.name))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    @property
+    def token(self):
+        """
+        The token of the current thread's acquisition or else of the oldest
+        acquisition - None if the lock is not held through this instance
+        """
+        token = getattr(self.__local, "token", None)
+        with self.__tokens_lock:
+            if token not in self.__tokens:
+                # not acquired by this thread or already released by another
+                token = self.__tokens[0] if self.__tokens else None
+        return token
+
+    def _pop_token(self):
+        token = getattr(self.__local, "token", None)
+        self.__local.token = None
+        with self.__tokens_lock:
+            if token not in self.__tokens:
+                token = self.__tokens[0] if self.__tokens else None
+            if token is not None:
+                self.__tokens.remove(token)
+        return token
+
+    def acquire(self, blocking=None, timeout=None):
+        """
+        Acquires the lock
+
+        :param blocking: overrides the blocking mode of the lock
+        :param timeout: overrides the timeout of the lock
+        :return: True if the lock was acquired, otherwise False
+        """
+        blocking = self.blocking if blocking is None else blocking
+        timeout = self.timeout if timeout is None else timeout
+        stop_at = None if timeout is None else time.time() + timeout
+        token = uuid4().hex
+        while True:
+            if self.__client.set(self.name, token, px=int(self.ttl * 1000), nx=True):
+                self.__local.token = token
+                with self.__tokens_lock:
+                    self.__tokens.append(token)
+                return True
+            if not blocking or (stop_at is not None and time.time() >= stop_at):
+                return False
+            time.sleep(self.sleep)
+
+    def release(self):
+        """
+        Releases the lock
+
+        :raises LockError: the lock is not held or the lease expired (unless raise_on_release is False)
+        """
+        token = self._pop_token()
+        if token is None:
+            if self.raise_on_release:
+                raise LockError("Cannot release an unlocked lock: {}".format(self.name))
+            logger.warn("Cannot release an unlocked lock: %s", self.name)
+            return
+        if not scripts.execute("compare_and_delete", keys=[self.name], args=[token], pipe=self.__client):
+            if self.raise_on_release:
+                raise LockError("Cannot release a lock that is no longer owned: {}".format(self.name))
+            logger.warn("Lock lease expired before release: %s", self.name)
+
+    def extend(self, ttl=None):
+        """
+        Extends the lease of the lock resetting its time to live
+
+        :param ttl: the new lease time in seconds or None to use the lock's ttl
+        :raises LockError: the lock is not held or the lease expired and the lock is owned by another
+        """
+        token = self.token
+        if token is None:
+            raise LockError("Cannot extend an unlocked lock: {}".format(self.name))
+        ttl = self.ttl if ttl is None else ttl
+        if not scripts.execute("compare_and_pexpire", keys=[self.name], args=[token, int(ttl * 1000)],
+                               pipe=self.__client):
+            raise LockError("Cannot extend a lock that is no longer owned: {}".format(self.name))
+
+    def locked(self):
+        """
+        :return: True if the lock is held by anyone
+        """
+        return bool(self.__client.exists(self.name))
+
+    def owned(self):
+        """
+        :return: True if the lock is held through this instance
+        """
+        token = self.token
+        return token is not None and native_str(self.__client.get(self.name)) == token
+
+
 def create_key(prefix, key, decode_key=False):
     """
     Creates a key
@@ -125,3 +403,134 @@ def incrby_field(key, field, amount=1, pipe=client):
     redis_key = create_key(key, field)
     return pipe.incrby(redis_key, amount=amount)
 
+
+def incrby_expire_field(key, field, amount=1, expire=None, pipe=client):
+    """
+    Atomically increments the given int field value by the amount and
+    sets the expiration of the field when it is created
+
+    :param key: a key
+    :param field: a field name
+    :param amount: the amount to increment by
+    :param expire: the number of seconds until the field expires or None
+    :param pipe: the pipe to use for the operation
+    :return: the current value of the field
+    """
+    redis_key = create_key(key, field)
+    return scripts.execute("incrby_expire", keys=[redis_key], args=[amount, expire or 0], pipe=pipe)
+
+
+def compare_and_set_field(key, field, expected, value, expire=None, pipe=client):
+    """
+    Atomically sets the field value if the current value equals the expected value
+
+    :param key: a key
+    :param field: a field name
+    :param expected: the expected current value
+    :param value: the value to set
+    :param expire: the number of seconds until the field expires or None
+    :param pipe: the pipe to use for the operation
+    :return: 1 if the value was set, otherwise 0
+    """
+    redis_key = create_key(key, field)
+    return scripts.execute("compare_and_set", keys=[redis_key], args=[expected, value, expire or 0], pipe=pipe)
+
+
+def compare_and_delete_field(key, field, expected, pipe=client):
+    """
+    Atomically deletes the field if the current value equals the expected value
+
+    :param key: a key
+    :param field: a field name
+    :param expected: the expected current value
+    :param pipe: the pipe to use for the operation
+    :return: 1 if the field was deleted, otherwise 0
+    """
+    redis_key = create_key(key, field)
+    return scripts.execute("compare_and_delete", keys=[redis_key], args=[expected], pipe=pipe)
+
+
+def push_capped_field(key, field, value, max_length, expire=None, pipe=client):
+    """
+    Atomically pushes a value onto the head of the list field and trims
+    the list to the max length
+
+    :param key: a key
+    :param field: a field name
+    :param value: the value to push
+    :param max_length: the maximum length of the list
+    :param expire: the number of seconds until the field expires or None
+    :param pipe: the pipe to use for the operation
+    :return: the length of the list
+    """
+    redis_key = create_key(key, field)
+    return scripts.execute("push_capped", keys=[redis_key], args=[value, max_length, expire or 0], pipe=pipe)
+
+
+def lock(name, ttl, blocking=True, timeout=None, sleep=0.1, raise_on_release=True):
+    """
+    Creates a distributed lock for the given name
+
+        with redis.lock("jobs:rebuild", 30):
+            pass
+
+    :param name: the lock name
+    :param ttl: the lease time in seconds
+    :param blocking: True to wait for the lock, False to fail immediately if it is held
+    :param timeout: the maximum number of seconds to wait for the lock or None to wait forever
+    :param sleep: the number of seconds to sleep between acquisition attempts
+    :param raise_on_release: False to log instead of raising when releasing an expired lease
+    :return: a Lock
+    """
+    return Lock(create_key(LOCK_PREFIX, name), ttl, blocking=blocking, timeout=timeout, sleep=sleep,
+                raise_on_release=raise_on_release)
+
+
+def lock_factory(ttl, prefix="cache", timeout=None, sleep=0.1):
+    """
+    Creates a lock factory that can be passed as the lock_factory argument of
+    the dorthy.cache backends so that value regeneration is serialized across
+    processes and hosts.  dogpile releases the mutex in a finally block, so a
+    lease that expires during a slow creation is logged instead of failing
+    get_or_create after the value has been stored.
+
+    :param ttl: the lease time in seconds - should exceed the value creation time
+    :param prefix: the prefix for the lock names
+    :param timeout: the maximum number of seconds to wait for the lock or None to wait forever
+    :param sleep: the number of seconds to sleep between acquisition attempts
+    :return: a function that creates a Lock for a cache key
+    """
+    def _lock_factory(key):
+        return lock("{}:{}".format(prefix, key), ttl, timeout=timeout, sleep=sleep, raise_on_release=False)
+    return _lock_factory
+
+
+def locked(name, ttl, blocking=False, timeout=None):
+    """
+    Decorator that runs the function only while holding the distributed lock.
+    If the lock cannot be acquired the function is skipped and None is returned.
+    Intended as a guard for tasks that are started in every worker process.
+
+        @runnable
+        @redis.locked("jobs:cleanup", 300)
+        def cleanup():
+            pass
+
+    :param name: the lock name
+    :param ttl: the lease time in seconds
+    :param blocking: True to wait for the lock, False to skip if it is held
+    :param timeout: the maximum number of seconds to wait for the lock or None to wait forever
+    """
+    def _locked(f, *args, **kwargs):
+        task_lock = lock(name, ttl, blocking=blocking, timeout=timeout)
+        if not task_lock.acquire():
+            logger.debug("Lock held elsewhere, skipping: %s", name)
+            return None
+        try:
+            return f(*args, **kwargs)
+        finally:
+            try:
+                task_lock.release()
+            except LockError:
+                logger.warn("Lock lease expired before task completed: %s", name)
+    return decorator(_locked)
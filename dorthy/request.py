@@ -4,6 +4,8 @@ import threading
 from collections import MutableMapping
 from contextlib import contextmanager
 
+from decorator import decorator
+
 from tornado.stack_context import StackContext
 
 from dorthy.dp import Observable
@@ -151,6 +153,24 @@ class RequestContextManager(object):
                 if self.__nesting == 0:
                     self.__request_context._release()
 
+    @staticmethod
+    @contextmanager
+    def attach(request_context):
+        """
+        Makes the RequestContext the active context of the current thread
+        without firing activate / deactivate events.  The context stays owned
+        by the request that activated it - used to run work for that request
+        on another thread.  A None context leaves the thread without a context.
+        """
+        if request_context is None:
+            yield
+            return
+        _request_store.context = request_context
+        try:
+            yield
+        finally:
+            _request_store.release()
+
     @staticmethod
     def active():
         return _request_store.active
@@ -162,6 +182,68 @@ class RequestContextManager(object):
         return _request_store.context
 
 
+_MEMOIZED_KEY = "__request_memoized"
+
+
+def _request_memoized_release(event, context):
+    # drop memoized values on deactivate events
+    if event == "deactivate":
+        context.pop(_MEMOIZED_KEY, None)
+
+
+def _get_memoized_cache(fn, copy_on_clone):
+    context = RequestContextManager.get_context()
+    if not context.contains_listener(_request_memoized_release):
+        context.register_listener(_request_memoized_release)
+
+    owner, caches = context.get(_MEMOIZED_KEY, (None, None))
+    if owner != context.id:
+        # the store was copied from the context this one was cloned from
+        caches = dict((k, (copy, dict(cache))) for k, (copy, cache) in caches.items() if copy) \
+            if caches else dict()
+        context[_MEMOIZED_KEY] = (context.id, caches)
+
+    if fn not in caches:
+        caches[fn] = (copy_on_clone, dict())
+    return caches[fn][1]
+
+
+def request_memoized(fn=None, copy_on_clone=True):
+    """
+    Decorator that caches the results of a function for the lifetime of
+    the active RequestContext.  Results are keyed by the function arguments
+    which must be hashable - otherwise the function is called without caching.
+    Outside of a request context the function is always called.
+
+        @request_memoized
+        def load_account(account_id):
+            pass
+
+    :param copy_on_clone: True to copy the memoized values into contexts cloned
+                          by @runnable, False to start the clone with an empty cache
+    """
+
+    def _request_memoized(f, *args, **kwargs):
+        if not RequestContextManager.active():
+            return f(*args, **kwargs)
+        try:
+            key = (args, frozenset(kwargs.items())) if kwargs else args
+            hash(key)
+        except TypeError:
+            return f(*args, **kwargs)
+
+        cache = _get_memoized_cache(f, copy_on_clone)
+        try:
+            return cache[key]
+        except KeyError:
+            value = cache[key] = f(*args, **kwargs)
+            return value
+
+    if fn is not None:
+        return decorator(_request_memoized, fn)
+    return decorator(_request_memoized)
+
+
 class ProxyHandlerMetaClass(type):
 
     def __init__(cls, name, base, dct):
@@ -1,5 +1,6 @@
 import inspect
 import logging
+import sys
 import traceback
 import urllib
 import urllib.parse
@@ -11,7 +12,7 @@ from decorator import decorator
 from tornado.escape import to_basestring
 from tornado.web import RequestHandler, HTTPError
 
-from dorthy import template
+from dorthy import metrics, template
 from dorthy.enum import DeclarativeEnum
 from dorthy.json import jsonify
 from dorthy.security.auth import AuthorizationHeaderToken
@@ -134,6 +135,9 @@ class BaseHandler(RequestHandler, WebRequestHandlerProxyMixin):
 
     USE_SECURE_COOKIE = True if "web.cookie_secret" in config and config.web.enabled("cookie_secret") else False
 
+    # adds a Server-Timing header with the database time of the request
+    SERVER_TIMING = True if "web.server_timing" in config and config.web.enabled("server_timing") else False
+
     def __init__(self, application, request, **kwargs):
         self.media_type = MediaTypes.HTML
         self.application = application
@@ -250,6 +254,17 @@ class BaseHandler(RequestHandler, WebRequestHandlerProxyMixin):
         elif self.__get_session_cookie():
             self.clear_cookie(self.SESSION_COOKIE_KEY)
 
+    def __report_query_stats(self):
+        # only applications that use the database have statement stats
+        db = sys.modules.get("dorthy.db")
+        if db is None:
+            return
+        if self.SERVER_TIMING and not self._headers_written:
+            timing = db.server_timing()
+            if timing:
+                self.add_header("Server-Timing", timing)
+        db.report_query_stats()
+
     def on_finish(self):
         pass
 
@@ -282,6 +297,7 @@ class BaseHandler(RequestHandler, WebRequestHandlerProxyMixin):
             # prevents a recursive loop on finish if exception raised
             self._request_finished = True
             self.__save_session()
+            self.__report_query_stats()
             self.on_finish()
         super().finish(chunk)
 
@@ -294,6 +310,8 @@ class BaseHandler(RequestHandler, WebRequestHandlerProxyMixin):
             message = "User not authorized."
         elif status_code == 403:
             message = "User forbidden."
+        elif status_code == 429:
+            message = "Too many requests."
         else:
             if exc_info:
                 if isinstance(exc_info[1], AccessDeniedError):
@@ -354,6 +372,20 @@ class TemplateHandler(BaseHandler):
         self.render(self.template)
 
 
+class MetricsHandler(BaseHandler):
+    """
+    Serves a JSON snapshot of the in-process metrics registry.  Secure the
+    route (e.g. subclass with @authenticated) before exposing it publicly.
+    """
+
+    def initialize(self, prefix=None):
+        self.prefix = prefix
+
+    def get(self):
+        self.set_nocache_headers()
+        self.write_results(metrics.snapshot(self.prefix), media=MediaTypes.JSON, camel_case=False)
+
+
 def authenticated(redirect=False, allow_header_auth=False):
 
     def _authenticated(f, handler, *args, **kwargs):